@@ -0,0 +1,44 @@
+import asyncio
+
+ALBUM_WINDOW = 1.0  # seconds of quiet after the last item before an album is flushed
+MAX_ALBUM_SIZE = 10  # Telegram's media group limit; a full album is flushed at once
+
+class AlbumAggregator:
+    """Collects the messages of an incoming media group (album).
+
+    Telegram delivers each album item as its own update. add() buffers them
+    by media_group_id and, once no new item has arrived for `window`
+    seconds, awaits on_album(messages) once with all of them in order.
+    Runs on the bot event loop.
+    """
+
+    def __init__(self, on_album, window=ALBUM_WINDOW):
+        self.on_album = on_album
+        self.window = window
+        self._albums = {}  # media_group_id -> [messages, timer handle]
+
+    def add(self, message):
+        key = message.media_group_id
+        entry = self._albums.get(key)
+        if entry is None:
+            entry = self._albums[key] = [[], None]
+        entry[0].append(message)
+        if entry[1] is not None:
+            entry[1].cancel()
+        if len(entry[0]) >= MAX_ALBUM_SIZE:
+            self._flush(key)
+        else:
+            entry[1] = asyncio.get_running_loop().call_later(self.window, self._flush, key)
+
+    def _flush(self, key):
+        entry = self._albums.pop(key, None)
+        if entry is None:
+            return
+        messages = sorted(entry[0], key=lambda m: m.message_id)
+        asyncio.ensure_future(self._deliver(messages))
+
+    async def _deliver(self, messages):
+        try:
+            await self.on_album(messages)
+        except Exception as e:
+            print(f"Error saving album {messages[0].media_group_id}: {e}")
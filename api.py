@@ -1,31 +1,46 @@
-import sqlite3
 import asyncio
-import os
-import requests
+import atexit
 from flask import Flask, jsonify, request, session, redirect, url_for, flash
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit, join_room
 from telegram import Update, Bot
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
-from threading import Thread
 from config import BOT_TOKEN, DASHBOARD_PASSWORD, CHANNEL_ID, GROUP_INVITE_LINK, CHANNEL_URL
 import datetime
+import html
+import json
+import os
 import traceback
 
-from db import init_db
+import stats
+from broadcast import BroadcastEngine
+from telegram_outbound import OutboundTelegram
+from runtime import BotRuntime
+from profile_cache import profiles
+import media
+import media_cache
+import cursors
+from albums import AlbumAggregator
+from events import EventBus, ADMIN_ROOM
+from presence import tracker as presence
+from follower import DatabaseFollower
+from join_requests import JoinRequestPipeline, BACKEND_MTPROTO, METRICS_NAME, catch_up_client
+from db import (
+    init_db, add_user, save_user_profile, user_exists, get_user, set_user_label, get_all_user_ids, get_users_page, get_users_after,
+    query_users, get_last_activity, get_connection,
+    search_messages, backfill_search_index, SNIPPET_START, SNIPPET_END, get_runtime_metrics,
+)
+# Message rows go through the write-behind queue; chat pages flush it first
+from message_writer import save_message, save_media_messages, get_messages_page
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import CallbackQueryHandler
-from telegram.ext import ChatJoinRequestHandler
 
 from pyrogram import Client, filters
-from pyrogram.types import ChatJoinRequest
 import config  # config.py should have BOT_TOKEN, API_ID, API_HASH, CHAT_ID, WELCOME_TEXT
 
 from telegram.ext import filters as tg_filters
-from pyrogram import filters as pyro_filters
 from telegram import InputMediaPhoto, InputMediaVideo, InputMediaAudio
-from telegram.request import HTTPXRequest as Request
 
 app = Flask(__name__)
 app.secret_key = 'change_this_secret_key'
@@ -36,19 +51,42 @@ CORS(app, origins=[
     "http://127.0.0.1:3000",
     "https://your-render-app.onrender.com",  # Update with your Render URL
     "https://your-railway-app.railway.app"   # Update with your Railway URL
-], supports_credentials=True)
+], supports_credentials=True, expose_headers=['X-Prev-Cursor', 'X-Next-Cursor'])
+
+# Socket.IO rooms live in this process unless a message queue is configured
+# (e.g. redis://redis:6379/0). With one, the API can run as several worker
+# processes and the bots in bot_runner.py still reach every dashboard.
+MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
 
-socketio = SocketIO(app, async_mode='threading', cors_allowed_origins=[
+socketio = SocketIO(app, async_mode='threading', message_queue=MESSAGE_QUEUE, cors_allowed_origins=[
     "http://localhost:3000",
     "http://127.0.0.1:3000",
     "https://your-render-app.onrender.com",  # Update with your Render URL
     "https://your-railway-app.railway.app"   # Update with your Railway URL
 ])
 
-DB_NAME = 'users.db'
+# Media refs become resolver URLs under the API's public base. Behind the
+# bundled nginx the API is served under /api/ with the prefix stripped, so
+# the request URL cannot be used; events are also built outside requests.
+PUBLIC_API_URL = (os.environ.get('PUBLIC_API_URL') or getattr(config, 'PUBLIC_API_URL', None)
+                  or 'http://localhost:5001/').rstrip('/') + '/'
+
+def media_url(file_unique_id):
+    return f"{PUBLIC_API_URL}media/{file_unique_id}"
+
+# Dashboard events are coalesced per room
+def public_message(text):
+    return media.to_public(text, media_url)
+
+events = EventBus(socketio, render=public_message, track_rooms=MESSAGE_QUEUE is None)
+# Online means a user message in the last 5 minutes; transitions are pushed
+# to dashboards in dashboard_update
+presence.on_change = events.presence
 
 # Ensure DB tables exist
 init_db()
+with get_connection() as conn:
+    presence.warm_up(conn)
 
 # Helper function to detect GIF files
 def is_gif_file(file_path, mimetype=None, original_filename=None):
@@ -84,184 +122,186 @@ def is_gif_by_header(file_path):
     except:
         return False
 
-def is_gif_by_url(url):
-    """Download file and check if it's a GIF by examining the header"""
-    try:
-        response = requests.get(url, stream=True)
-        if response.status_code == 200:
-            # Read first 6 bytes to check GIF header
-            header = response.raw.read(6)
-            return header.startswith(b'GIF87a') or header.startswith(b'GIF89a')
-    except:
-        pass
-    return False
-
-# --- Database helpers ---
-def get_all_users():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT user_id, full_name, username, join_date, invite_link, photo_url, label FROM users')
-    users = c.fetchall()
-    conn.close()
-    return users
-
-def get_total_users():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT COUNT(*) FROM users')
-    total = c.fetchone()[0]
-    conn.close()
-    return total
-
-def get_messages_for_user(user_id, limit=100):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT sender, message, timestamp FROM messages WHERE user_id = ? ORDER BY id ASC LIMIT ?', (user_id, limit))
-    messages = c.fetchall()
-    conn.close()
-    return messages
-
-def save_message(user_id, sender, message):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('INSERT INTO messages (user_id, sender, message, timestamp) VALUES (?, ?, ?, ?)',
-              (user_id, sender, message, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
-    conn.commit()
-    conn.close()
-
-def add_user(user_id, full_name, username, join_date, invite_link, photo_url=None, label=None):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('INSERT OR IGNORE INTO users (user_id, full_name, username, join_date, invite_link, photo_url, label) VALUES (?, ?, ?, ?, ?, ?, ?)', (user_id, full_name, username, join_date, invite_link, photo_url, label))
-    conn.commit()
-    conn.close()
-
-def get_active_users(minutes=60):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    since = (datetime.datetime.now() - datetime.timedelta(minutes=minutes)).strftime('%Y-%m-%d %H:%M:%S')
-    c.execute('SELECT COUNT(DISTINCT user_id) FROM messages WHERE timestamp >= ?', (since,))
-    count = c.fetchone()[0]
-    conn.close()
-    return count
-
-def get_total_messages():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT COUNT(*) FROM messages')
-    count = c.fetchone()[0]
-    conn.close()
-    return count
-
-def get_new_joins_today():
-    today = datetime.datetime.now().strftime('%Y-%m-%d')
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT COUNT(*) FROM users WHERE join_date LIKE ?', (f'{today}%',))
-    count = c.fetchone()[0]
-    conn.close()
-    return count
-
-def get_user_online_status(user_id, minutes=5):
-    """Check if user has been active in the last N minutes"""
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    since = (datetime.datetime.now() - datetime.timedelta(minutes=minutes)).strftime('%Y-%m-%d %H:%M:%S')
-    c.execute('SELECT 1 FROM messages WHERE user_id = ? AND timestamp >= ? LIMIT 1', (user_id, since))
-    is_online = c.fetchone() is not None
-    conn.close()
-    return is_online
-
 @app.route('/user-status/<int:user_id>')
 def user_status(user_id):
     """Get user online status and last activity"""
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    
-    # Get last message timestamp
-    c.execute('SELECT timestamp FROM messages WHERE user_id = ? ORDER BY id DESC LIMIT 1', (user_id,))
-    last_message = c.fetchone()
+    # Last message time: from the presence tracker when the user has written
+    # since startup, otherwise from the messages table
+    last_activity = presence.last_seen(user_id) or get_last_activity(user_id)
     
     # Check if online (active in last 5 minutes)
-    is_online = get_user_online_status(user_id, 5)
+    is_online = presence.is_online(user_id)
     
     # Get user info
-    c.execute('SELECT full_name, username, photo_url FROM users WHERE user_id = ?', (user_id,))
-    user_info = c.fetchone()
-    
-    conn.close()
+    user_info = get_user(user_id)
     
     return jsonify({
         'user_id': user_id,
         'full_name': user_info[0] if user_info else '',
         'username': user_info[1] if user_info else '',
-        'photo_url': user_info[2] if user_info else None,
+        'photo_url': media.to_public(user_info[2], media_url) if user_info else None,
         'is_online': is_online,
-        'last_activity': last_message[0] if last_message else None
+        'last_activity': last_activity
     })
 
 # --- Flask API Endpoints ---
+def limit_arg(name, default, maximum):
+    """Integer query arg clamped to 1..maximum; default when missing or not a number"""
+    return max(1, min(request.args.get(name, default, type=int), maximum))
+
 @app.route('/dashboard-users')
 def dashboard_users():
-    # Get page and page_size from query params, default page=1, page_size=10
-    page = int(request.args.get('page', 1))
-    page_size = int(request.args.get('page_size', 10))
-    offset = (page - 1) * page_size
-
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT COUNT(*) FROM users')
-    total = c.fetchone()[0]
-    c.execute('SELECT user_id, full_name, username, join_date, invite_link, photo_url, label FROM users ORDER BY join_date DESC LIMIT ? OFFSET ?', (page_size, offset))
-    users = c.fetchall()
-    conn.close()
-
-    # Add online status for each user
-    users_with_status = []
-    for u in users:
-        is_online = get_user_online_status(u[0], 5)
-        users_with_status.append({
-                'user_id': u[0],
-                'full_name': u[1],
-                'username': u[2],
-                'join_date': u[3],
-            'invite_link': u[4],
-            'photo_url': u[5],
-            'is_online': is_online,
-            'label': u[6]
-        })
+    # Keyset pagination: pass the returned next_cursor as ?cursor= for the
+    # following page. ?page= (LIMIT/OFFSET) still works for old clients.
+    page_size = limit_arg('page_size', 10, 200)
+    cursor = request.args.get('cursor')
+    page = max(1, request.args.get('page', 1, type=int))
+
+    total = stats.engine.snapshot()['total_users']
+    if cursor:
+        try:
+            join_date, after_user_id = cursors.decode(cursor, 2)
+            after_user_id = int(after_user_id)
+        except (ValueError, TypeError):
+            return jsonify({'status': 'error', 'message': 'Invalid cursor'}), 400
+        users = get_users_after(page_size, join_date, after_user_id)
+    else:
+        users = get_users_page(page_size, (page - 1) * page_size)
 
+    next_cursor = cursors.encode(users[-1][3], users[-1][0]) if len(users) == page_size else None
     return jsonify({
-        'users': users_with_status,
+        'users': users_with_status(users),
         'total': total,
         'page': page,
-        'page_size': page_size
+        'page_size': page_size,
+        'next_cursor': next_cursor
     })
 
-@app.route('/dashboard-stats')
-def dashboard_stats():
-    # Total users in the database
-    total_users = get_total_users()
-    # Active users: users who sent messages in the last 60 minutes
-    active_users = get_active_users()  # last 60 minutes
-    # Total messages sent (all time)
-    total_messages = get_total_messages()
-    # New joins today
-    new_joins_today = get_new_joins_today()
+def users_with_status(users):
+    # Online status for the whole page from the presence tracker
+    online_ids = presence.online_ids([u[0] for u in users])
+    return [{
+        'user_id': u[0],
+        'full_name': u[1],
+        'username': u[2],
+        'join_date': u[3],
+        'invite_link': u[4],
+        'photo_url': media.to_public(u[5], media_url),
+        'is_online': u[0] in online_ids,
+        'label': u[6]
+    } for u in users]
+
+@app.route('/users')
+def users_query():
+    # Filters combine with AND: q (name/username, substring), label,
+    # joined_from/joined_to (join_date range), online_within (minutes),
+    # has_invite_link (true/false). Paged like /dashboard-users via cursor;
+    # total counts all matches. It is computed for the first page only and
+    # carried forward in the cursor, so later pages are plain keyset reads.
+    page_size = limit_arg('page_size', 50, 200)
+    filters = {
+        'name': request.args.get('q', '').strip() or None,
+        'label': request.args.get('label'),
+        'joined_from': request.args.get('joined_from'),
+        'joined_to': request.args.get('joined_to'),
+    }
+    online_within = request.args.get('online_within', type=int)
+    if online_within:
+        since = datetime.datetime.now() - datetime.timedelta(minutes=online_within)
+        filters['active_since'] = since.strftime('%Y-%m-%d %H:%M:%S')
+    if 'has_invite_link' in request.args:
+        filters['has_invite_link'] = request.args['has_invite_link'].lower() in ('1', 'true', 'yes')
+    after = cursor_total = None
+    if request.args.get('cursor'):
+        try:
+            join_date, after_user_id, cursor_total = cursors.decode(request.args['cursor'], 3)
+            after = (join_date, int(after_user_id))
+        except (ValueError, TypeError):
+            return jsonify({'status': 'error', 'message': 'Invalid cursor'}), 400
+
+    if any(value is not None for value in filters.values()):
+        users, total = query_users(page_size, after=after, **filters)
+        if total is None:
+            total = cursor_total
+    else:
+        # Unfiltered: plain keyset page, total from the stats counters
+        users = get_users_after(page_size, *(after or (None, None)))
+        total = stats.engine.snapshot()['total_users']
+
+    next_cursor = cursors.encode(users[-1][3], users[-1][0], total) if len(users) == page_size else None
     return jsonify({
-        'total_users': total_users,
-        'active_users': active_users,
-        'total_messages': total_messages,
-        'new_joins_today': new_joins_today
+        'users': users_with_status(users),
+        'total': total,
+        'page_size': page_size,
+        'next_cursor': next_cursor
     })
 
+@app.route('/dashboard-stats')
+def dashboard_stats():
+    # Counters are maintained by db.py as rows are written: total users,
+    # users active in the last 60 minutes, total messages, new joins today
+    return jsonify(stats.engine.snapshot())
+
 @app.route('/chat/<int:user_id>/messages')
 def chat_messages(user_id):
-    messages = get_messages_for_user(user_id)
-    # messages is a list of (sender, message, timestamp)
-    return jsonify([
-        [sender, message, timestamp] for sender, message, timestamp in messages
+    # Newest messages first: ?before=<X-Prev-Cursor> pages back through older
+    # history, ?after=<X-Next-Cursor> fetches what arrived since. The body
+    # stays a chronological list of [sender, message, timestamp].
+    limit = limit_arg('limit', 100, 500)
+    try:
+        before_id = int(cursors.decode(request.args['before'], 1)[0]) if 'before' in request.args else None
+        after_id = int(cursors.decode(request.args['after'], 1)[0]) if 'after' in request.args else None
+    except (ValueError, TypeError):
+        return jsonify({'status': 'error', 'message': 'Invalid cursor'}), 400
+    rows = get_messages_page(user_id, limit, before_id, after_id)
+    # Media references become resolver URLs, so only media the dashboard displays is fetched
+    response = jsonify([
+        [sender, media.to_public(message, media_url), timestamp] for _, sender, message, timestamp in rows
     ])
+    if rows:
+        response.headers['X-Prev-Cursor'] = cursors.encode(rows[0][0])
+        response.headers['X-Next-Cursor'] = cursors.encode(rows[-1][0])
+    elif after_id is not None:
+        response.headers['X-Next-Cursor'] = request.args['after']
+    return response
+
+@app.route('/search')
+def search():
+    # Full-text search over message history; every word matches as a prefix
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'status': 'error', 'message': 'Missing q'}), 400
+    user_id = request.args.get('user_id', type=int)
+    limit = limit_arg('limit', 20, 100)
+    results = []
+    for message_id, result_user_id, full_name, sender, snippet, timestamp in search_messages(query, user_id, limit):
+        # Matches are highlighted with <mark>; the rest of the text is escaped
+        snippet = html.escape(snippet).replace(SNIPPET_START, '<mark>').replace(SNIPPET_END, '</mark>')
+        results.append({
+            'id': message_id,
+            'user_id': result_user_id,
+            'full_name': full_name,
+            'sender': sender,
+            'snippet': snippet,
+            'timestamp': timestamp,
+        })
+    return jsonify({'query': query, 'results': results})
+
+@app.route('/media/<file_unique_id>')
+def media_file(file_unique_id):
+    # Served from the local disk cache; the first view downloads it from Telegram
+    relpath = media_cache.cache.lookup(file_unique_id)
+    if relpath is None:
+        try:
+            relpath = outbound.run(
+                media_cache.cache.fetch(bot, file_unique_id), timeout=media_cache.DOWNLOAD_TIMEOUT
+            )
+        except Exception as e:
+            print(f"Could not fetch media {file_unique_id}: {e}")
+            return jsonify({'status': 'error', 'message': 'Media unavailable'}), 502
+        if relpath is None:
+            return jsonify({'status': 'error', 'message': 'Unknown media'}), 404
+    return media_cache.cache.serve(relpath)
 
 @app.route('/get_channel_invite_link', methods=['GET'])
 def get_channel_invite_link():
@@ -273,157 +313,126 @@ def get_channel_invite_link():
         return jsonify({'error': str(e)}), 500
 
 # --- Telegram Bot Handlers ---
-bot = Bot(BOT_TOKEN, request=Request(connect_timeout=30, read_timeout=30))
-loop = asyncio.new_event_loop()
-asyncio.set_event_loop(loop)
+# Sends from Flask and background jobs run on the outbound loop thread
+outbound = OutboundTelegram(BOT_TOKEN)
+outbound.start()
+atexit.register(outbound.stop)
+bot = outbound.bot
+
+async def refresh_profile_photo(bot, user_id):
+    """Background profile-photo lookup; writes only if the photo changed"""
+    try:
+        photos = await bot.get_user_profile_photos(user_id, limit=1)
+        photo_url = None
+        if photos.total_count > 0:
+            # Stored as a media reference, resolved when the dashboard shows it
+            photo_url = await asyncio.to_thread(media.register, photos.photos[0][0], 'profile_photo')
+    except Exception as e:
+        print(f"Could not fetch profile photo for user {user_id}: {e}")
+        return
+    profile = profiles.get(user_id)
+    if profile is not None and photo_url and photo_url != profile.photo_url:
+        await asyncio.to_thread(save_user_profile, user_id, profile.full_name, profile.username, None, photo_url)
+        profiles.put(user_id, profile.full_name, profile.username, photo_url)
+
+async def sync_user_profile(user_id, full_name, username):
+    """Make sure the users row matches the sender, writing only on change"""
+    profile = profiles.get(user_id)
+    if profile is None:
+        row = await asyncio.to_thread(get_user, user_id)
+        if row is not None:
+            profiles.put(user_id, row[0], row[1], row[2])
+            profile = profiles.get(user_id)
+    if profile is None or profile.full_name != full_name or profile.username != username:
+        join_date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        await asyncio.to_thread(save_user_profile, user_id, full_name, username, join_date)
+        profiles.put(user_id, full_name, username, profile.photo_url if profile else None)
+
+async def save_user_album(messages):
+    """Store a user's album as one transaction and notify the dashboard once"""
+    user = messages[0].from_user
+    full_name = f"{user.first_name or ''} {user.last_name or ''}".strip()
+    username = user.username or ''
+    await sync_user_profile(user.id, full_name, username)
+    if profiles.claim_photo_refresh(user.id):
+        asyncio.ensure_future(refresh_profile_photo(bot, user.id))
+
+    media_rows = []
+    message_rows = []
+    for msg in messages:
+        # Albums hold photos, videos and audio; GIFs can't be part of one
+        attachment, media_type = media.attachment_of(msg)
+        if attachment is None:
+            continue
+        media_rows.append(media.media_row(attachment, media_type))
+        message_rows.append((user.id, 'user', f'[{media_type}]{media.REF_PREFIX}{attachment.file_unique_id}', None))
+    if not message_rows:
+        return
+    await asyncio.to_thread(save_media_messages, media_rows, message_rows)
+    events.messages(message_rows, full_name, username)
+
+user_albums = AlbumAggregator(save_user_album)
 
 async def user_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if user is None:
         return
+    presence.seen(user.id)
+    # Items of a media group arrive as separate updates; they are buffered
+    # and handled once per album by save_user_album
+    if update.message.media_group_id:
+        user_albums.add(update.message)
+        return
     full_name = f"{user.first_name or ''} {user.last_name or ''}".strip()
     username = user.username or ''
-    join_date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    # Fetch profile photo URL
-    photo_url = None
-    try:
-        photos = await context.bot.get_user_profile_photos(user.id, limit=1)
-        if photos.total_count > 0:
-            file = await context.bot.get_file(photos.photos[0][0].file_id)
-            photo_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-    except Exception as e:
-        print(f"Could not fetch profile photo for user {user.id}: {e}")
-    add_user(user.id, full_name, username, join_date, None, photo_url)
-
-    # Handle bulk media: For each message in a media group, this handler is called separately
-    if update.message.photo:
-        file = await context.bot.get_file(update.message.photo[-1].file_id)
-        # Check if file_path already contains the full URL
-        if file.file_path.startswith('http'):
-            file_url = file.file_path
-        else:
-            file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-        
-        # Get original file information - try multiple ways
-        original_filename = None
-        mime_type = None
-        
-        # Try to get file_name from the photo object
-        try:
-            original_filename = getattr(update.message.photo[-1], 'file_name', None)
-        except:
-            pass
-            
-        # Try to get mime_type from the photo object
-        try:
-            mime_type = getattr(update.message.photo[-1], 'mime_type', None)
-        except:
-            pass
-            
-        # If we don't have the original info, try to get it from the file object
-        if not original_filename:
-            try:
-                original_filename = getattr(file, 'file_name', None)
-            except:
-                pass
-                
-        if not mime_type:
-            try:
-                mime_type = getattr(file, 'mime_type', None)
-            except:
-                pass
-        
-        # Check message caption for GIF hints
-        caption = getattr(update.message, 'caption', '')
-        if caption and 'gif' in caption.lower():
-            print(f"Debug - Found GIF hint in caption: {caption}")
-        
-        # Check if message has any GIF-specific attributes
-        message_type = getattr(update.message, 'content_type', None)
-        print(f"Debug - Message content type: {message_type}")
-        
-        # Check if this is a GIF file using original information
-        is_gif = is_gif_file(file.file_path, mimetype=mime_type, original_filename=original_filename)
-        
-        # If we couldn't detect it by filename/mimetype, try checking the actual file content
-        if not is_gif and file_url:
-            print(f"Debug - Trying to check file content for GIF...")
-            is_gif = is_gif_by_url(file_url)
-            print(f"Debug - File content check result: {is_gif}")
-        
-        # Additional check: if the file path contains 'gif' anywhere, it might be a GIF
-        if not is_gif and 'gif' in file.file_path.lower():
-            print(f"Debug - Found 'gif' in file path, treating as GIF")
-            is_gif = True
-        
-        print(f"Debug - user image file.file_path: {file.file_path}")
-        print(f"Debug - user image constructed URL: {file_url}")
-        print(f"Debug - original filename: {original_filename}")
-        print(f"Debug - mime type: {mime_type}")
-        print(f"Debug - caption: {caption}")
-        print(f"Debug - message content type: {message_type}")
-        print(f"Debug - is GIF: {is_gif}")
-        print(f"Debug - photo object attributes: {dir(update.message.photo[-1])}")
-        print(f"Debug - file object attributes: {dir(file)}")
-        print(f"Debug - message object attributes: {dir(update.message)}")
-        
-        # Save with appropriate prefix for GIFs
-        if is_gif:
-            save_message(user.id, 'user', f"[gif]{file_url}")
-            print(f"Debug - Saved as GIF: [gif]{file_url}")
-        else:
-            save_message(user.id, 'user', f"[image]{file_url}")
-            print(f"Debug - Saved as image: [image]{file_url}")
-        
+    await sync_user_profile(user.id, full_name, username)
+    # Profile photo is looked up in the background, at most once per interval per user
+    if profiles.claim_photo_refresh(user.id):
+        context.application.create_task(refresh_profile_photo(context.bot, user.id))
+
+    # media.register commits the media row; it runs off the shared bot loop
+    if update.message.animation:
+        # Telegram delivers GIFs as animations, so no probe is needed
+        ref = await asyncio.to_thread(media.register, update.message.animation, 'gif')
+        save_message(user.id, 'user', f"[gif]{ref}")
+        events.message(user.id, 'user', f"[gif]{ref}", full_name=full_name, username=username)
+    elif update.message.photo:
+        # A PhotoSize is always a re-encoded JPEG (GIFs arrive as animations),
+        # so the file is only resolved lazily, like video and audio
+        ref = await asyncio.to_thread(media.register, update.message.photo[-1], 'image')
+        save_message(user.id, 'user', f"[image]{ref}")
         # Real-time notify admin dashboard
-        socketio.emit('new_message', {'user_id': user.id, 'full_name': full_name, 'username': username})
+        events.message(user.id, 'user', f"[image]{ref}", full_name=full_name, username=username)
     elif update.message.video:
-        file = await context.bot.get_file(update.message.video.file_id)
-        # Check if file_path already contains the full URL
-        if file.file_path.startswith('http'):
-            file_url = file.file_path
-        else:
-            file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-        save_message(user.id, 'user', f"[video]{file_url}")
+        # The file is resolved lazily when the dashboard shows it
+        ref = await asyncio.to_thread(media.register, update.message.video, 'video')
+        save_message(user.id, 'user', f"[video]{ref}")
         # Real-time notify admin dashboard
-        socketio.emit('new_message', {'user_id': user.id, 'full_name': full_name, 'username': username})
+        events.message(user.id, 'user', f"[video]{ref}", full_name=full_name, username=username)
     elif update.message.voice:
-        file = await context.bot.get_file(update.message.voice.file_id)
-        # Check if file_path already contains the full URL
-        if file.file_path.startswith('http'):
-            file_url = file.file_path
-        else:
-            file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-        save_message(user.id, 'user', f"[voice]{file_url}")
+        # The file is resolved lazily when the dashboard shows it
+        ref = await asyncio.to_thread(media.register, update.message.voice, 'voice')
+        save_message(user.id, 'user', f"[voice]{ref}")
         # Real-time notify admin dashboard
-        socketio.emit('new_message', {'user_id': user.id, 'full_name': full_name, 'username': username})
+        events.message(user.id, 'user', f"[voice]{ref}", full_name=full_name, username=username)
     elif update.message.audio:
-        file = await context.bot.get_file(update.message.audio.file_id)
-        # Check if file_path already contains the full URL
-        if file.file_path.startswith('http'):
-            file_url = file.file_path
-        else:
-            file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-        save_message(user.id, 'user', f"[audio]{file_url}")
+        # The file is resolved lazily when the dashboard shows it
+        ref = await asyncio.to_thread(media.register, update.message.audio, 'audio')
+        save_message(user.id, 'user', f"[audio]{ref}")
         # Real-time notify admin dashboard
-        socketio.emit('new_message', {'user_id': user.id, 'full_name': full_name, 'username': username})
+        events.message(user.id, 'user', f"[audio]{ref}", full_name=full_name, username=username)
     elif update.message.text:
         save_message(user.id, 'user', update.message.text)
 
         # Real-time notify admin dashboard
-        socketio.emit('new_message', {'user_id': user.id, 'full_name': full_name, 'username': username})
+        events.message(user.id, 'user', update.message.text, full_name=full_name, username=username)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if user is None:
         return
     # Check if user is new or old
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT 1 FROM users WHERE user_id = ?', (user.id,))
-    exists = c.fetchone()
-    conn.close()
-    if exists:
+    if user_exists(user.id):
         # Old user: just private message
         await update.message.reply_text("👋 Welcome back! You can chat with me here anytime.")
     else:
@@ -472,79 +481,81 @@ async def channel_joined_callback(update: Update, context: ContextTypes.DEFAULT_
     except Exception:
         pass
 
-async def approve_join(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        await update.chat_join_request.approve()
-        user = update.chat_join_request.from_user
-        # Store user info in DB
-        full_name = f"{user.first_name or ''} {user.last_name or ''}".strip()
-        username = user.username or ''
-        join_date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        invite_link = update.chat_join_request.invite_link.invite_link if update.chat_join_request.invite_link else None
-        add_user(user.id, full_name, username, join_date, invite_link)
-        try:
-            await context.bot.send_message(user.id, "🎉 Welcome! You are now a member. Feel free to chat with me.")
-        except Exception as e:
-            print(f"Failed to send welcome message: {e}")
-    except Exception as e:
-        if "User_already_participant" in str(e):
-            print(f"User is already a participant, skipping approval")
-        else:
-            print(f"Error approving join request: {e}")
-
 # Register handlers for Telegram bot
-application = ApplicationBuilder().token(BOT_TOKEN).build()
+# The application shares the outbound Bot, so polling, handler replies and
+# Flask sends all use one HTTP pool on one loop
+application = ApplicationBuilder().bot(bot).build()
 application.add_handler(CommandHandler('start', start))
 application.add_handler(CallbackQueryHandler(channel_joined_callback, pattern='^joined_channel$'))
 application.add_handler(MessageHandler(tg_filters.TEXT & ~tg_filters.COMMAND, user_message_handler))
 application.add_handler(MessageHandler(tg_filters.PHOTO, user_message_handler))
+application.add_handler(MessageHandler(tg_filters.ANIMATION, user_message_handler))
 application.add_handler(MessageHandler(tg_filters.VIDEO, user_message_handler))
 application.add_handler(MessageHandler(tg_filters.VOICE, user_message_handler))
 application.add_handler(MessageHandler(tg_filters.AUDIO, user_message_handler))
-application.add_handler(ChatJoinRequestHandler(approve_join))
 
 # Pyrogram Bot Setup
-pyro_app = Client(
-    "AutoApproveBot",
-    bot_token=config.BOT_TOKEN,
-    api_id=config.API_ID,
-    api_hash=config.API_HASH
-)
+# Pyrogram binds the client to the event loop current at construction time,
+# so build it on the outbound loop it will run on
+async def create_pyro_client():
+    return Client(
+        "AutoApproveBot",
+        bot_token=config.BOT_TOKEN,
+        api_id=config.API_ID,
+        api_hash=config.API_HASH
+    )
+
+pyro_app = outbound.run(create_pyro_client())
 
 CHAT_ID = config.CHAT_ID
 WELCOME_TEXT = getattr(config, "WELCOME_TEXT", "🎉 Hi {mention}, you are now a member of {title}!")
 
-@pyro_app.on_chat_join_request(pyro_filters.chat(CHAT_ID))
-async def approve_and_dm(client: Client, join_request: ChatJoinRequest):
-    user = join_request.from_user
-    chat = join_request.chat
-
+# Join requests are handled by one pipeline on one backend ('mtproto' via
+# Pyrogram or 'botapi' via PTB), never both
+join_pipeline = JoinRequestPipeline(
+    getattr(config, 'JOIN_REQUEST_BACKEND', BACKEND_MTPROTO),
+    chat_id=CHAT_ID,
+    welcome_text=WELCOME_TEXT,
+)
+join_pipeline.register(application, pyro_app)
+
+@app.route('/join-queue-stats')
+def join_queue_stats():
+    # Queue depth, backlog age and approval latency of the join scheduler.
+    # Without the bots in this process, serve what bot_runner.py last published.
+    if runtime.running:
+        return jsonify({**join_pipeline.snapshot(), 'published_at': None})
+    row = get_runtime_metrics(METRICS_NAME)
+    if row is None:
+        return jsonify({'error': 'the bot process has not published join metrics yet'}), 503
+    return jsonify({**json.loads(row[0]), 'published_at': row[1]})
+
+
+def record_admin_media(user_id, sent_messages, files):
+    """Store media references for what chat_send delivered.
+
+    file_id and file_unique_id come straight from the send result, so no
+    get_file round-trip is needed; the media rows and message rows for the
+    whole album are committed in one transaction.
+    """
+    media_rows = []
+    message_rows = []
+    for i, msg in enumerate(sent_messages):
+        attachment, media_type = media.attachment_of(msg)
+        if attachment is None:
+            continue
+        # For admin uploads, check the original file info
+        original_filename = files[i].filename if i < len(files) else None
+        original_mimetype = files[i].mimetype if i < len(files) else None
+        if media_type == 'image' and is_gif_file(original_filename, mimetype=original_mimetype, original_filename=original_filename):
+            media_type = 'gif'
+        media_rows.append(media.media_row(attachment, media_type, original_filename))
+        message_rows.append((user_id, 'admin', f'[{media_type}]{media.REF_PREFIX}{attachment.file_unique_id}', None))
     try:
-        await client.approve_chat_join_request(chat.id, user.id)
-        print(f"Approved: {user.first_name} ({user.id}) in {chat.title}")
-
-        # Add user to DB (reuse add_user from api.py)
-        from datetime import datetime
-        full_name = f"{user.first_name or ''} {user.last_name or ''}".strip()
-        username = user.username or ''
-        join_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        invite_link = None  # Pyrogram does not provide invite_link in join request
-        add_user(user.id, full_name, username, join_date, invite_link)
-
-        try:
-            await client.send_message(
-                user.id,
-                WELCOME_TEXT.format(mention=user.mention, title=chat.title)
-            )
-            print(f"DM sent to {user.first_name} ({user.id})")
-        except Exception as e:
-            print(f"Failed to send DM to {user.first_name} ({user.id}): {e}")
+        save_media_messages(media_rows, message_rows)
+        events.messages(message_rows)
     except Exception as e:
-        if "User_already_participant" in str(e) or "USER_ALREADY_PARTICIPANT" in str(e):
-            print(f"User {user.first_name} ({user.id}) is already a participant in {chat.title}")
-        else:
-            print(f"Error approving join request for {user.first_name} ({user.id}): {e}")
-
+        print(f"Error saving admin media: {e}")
 
 @app.route('/chat/<int:user_id>', methods=['POST'])
 def chat_send(user_id):
@@ -556,10 +567,11 @@ def chat_send(user_id):
     # Handle text message
     if message:
         save_message(user_id, 'admin', message)
+        events.message(user_id, 'admin', message)
         try:
-            asyncio.run_coroutine_threadsafe(
-                bot.send_message(chat_id=int(user_id), text=message), loop
-            )
+            outbound.submit(
+                bot.send_message(chat_id=int(user_id), text=message)
+            ).result(timeout=30)
             sent = True
             response = {'status': 'success', 'message': 'Message sent'}
         except Exception as e:
@@ -570,7 +582,7 @@ def chat_send(user_id):
     # Handle files
     if files and len(files) > 0:
         media_group = []  # Unified media group for all types
-        temp_paths = []
+        media_files = []  # the upload behind each media_group item
         
         # File size validation (Telegram limits: 50MB for files, 20MB for photos)
         MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
@@ -591,171 +603,59 @@ def chat_send(user_id):
             elif file_size > MAX_FILE_SIZE:
                 return jsonify({'status': 'error', 'message': f'File {filename} is too large. Maximum size is 50MB.'}), 400
             
-            temp_path = f'temp_{filename}'
-            file.save(temp_path)
-            temp_paths.append(temp_path)
-            
-            # Check if this is a GIF file before processing
-            is_gif = is_gif_file(temp_path, mimetype=mimetype, original_filename=filename)
-            print(f"Debug - admin upload: filename={filename}, mimetype={mimetype}, is_gif={is_gif}")
-            
-            # Add to unified media group
+            # Add to unified media group straight from the upload stream (werkzeug
+            # spools large uploads to an anonymous temp file, so nothing named is
+            # written to disk); the stream is closed once the request is done
             if mimetype.startswith('image/'):
-                media_group.append(InputMediaPhoto(open(temp_path, 'rb')))
+                media_group.append(InputMediaPhoto(file.stream, filename=filename))
             elif mimetype.startswith('video/'):
-                media_group.append(InputMediaVideo(open(temp_path, 'rb')))
+                media_group.append(InputMediaVideo(file.stream, filename=filename))
             elif mimetype.startswith('audio/'):
-                media_group.append(InputMediaAudio(open(temp_path, 'rb')))
+                media_group.append(InputMediaAudio(file.stream, filename=filename))
+            else:
+                continue
+            media_files.append(file)
         
         try:
             if len(media_group) > 1:
                 print(f'Sending unified media group ({len(media_group)} files)...')
-                fut = asyncio.run_coroutine_threadsafe(
-                    bot.send_media_group(chat_id=int(user_id), media=media_group), loop
+                fut = outbound.submit(
+                    bot.send_media_group(chat_id=int(user_id), media=media_group)
                 )
                 result = fut.result(timeout=120)  # 120 second timeout for bulk upload
-                
-                # Save each media URL separately
-                for i, msg in enumerate(result):
-                    try:
-                        file_url = None
-                        media_type = None
-                        
-                        if msg.photo:
-                            file = asyncio.run_coroutine_threadsafe(
-                                bot.get_file(msg.photo[-1].file_id), loop
-                            ).result(timeout=30)
-                            media_type = 'image'
-                        elif msg.video:
-                            file = asyncio.run_coroutine_threadsafe(
-                                bot.get_file(msg.video.file_id), loop
-                            ).result(timeout=30)
-                            media_type = 'video'
-                        elif msg.audio:
-                            file = asyncio.run_coroutine_threadsafe(
-                                bot.get_file(msg.audio.file_id), loop
-                            ).result(timeout=30)
-                            media_type = 'audio'
-                        
-                        if file:
-                            # Check if file_path already contains the full URL
-                            if file.file_path.startswith('http'):
-                                file_url = file.file_path
-                            else:
-                                file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-                            
-                            # For admin uploads, check the original file info
-                            original_filename = files[i].filename if i < len(files) else None
-                            original_mimetype = files[i].mimetype if i < len(files) else None
-                            is_gif = is_gif_file(file.file_path, mimetype=original_mimetype, original_filename=original_filename)
-                            
-                            print(f"Debug - admin bulk {media_type}: {file.file_path}")
-                            print(f"Debug - admin bulk URL: {file_url}")
-                            print(f"Debug - admin bulk original: {original_filename}")
-                            print(f"Debug - admin bulk is GIF: {is_gif}")
-                            
-                            # Save with appropriate prefix
-                            if media_type == 'image':
-                                if is_gif:
-                                    save_message(user_id, 'admin', f'[gif]{file_url}')
-                                else:
-                                    save_message(user_id, 'admin', f'[image]{file_url}')
-                            elif media_type == 'video':
-                                save_message(user_id, 'admin', f'[video]{file_url}')
-                            elif media_type == 'audio':
-                                save_message(user_id, 'admin', f'[audio]{file_url}')
-                            
-                            print(f"Debug - Admin bulk {media_type} saved: [{media_type}]{file_url}")
-                    except Exception as e:
-                        print(f"Error processing bulk media {i}: {e}")
-                        # Still save the message even if we can't get the file URL
-                        save_message(user_id, 'admin', f'[{media_type}]sent')
-                
-                sent = True
             elif len(media_group) == 1:
                 # Single file - send individually
-                media = media_group[0]
-                if isinstance(media, InputMediaPhoto):
+                item = media_group[0]
+                if isinstance(item, InputMediaPhoto):
                     print('Sending single image...')
-                    fut = asyncio.run_coroutine_threadsafe(
-                        bot.send_photo(chat_id=int(user_id), photo=media.media), loop
+                    fut = outbound.submit(
+                        bot.send_photo(chat_id=int(user_id), photo=item.media)
                     )
-                    result = fut.result(timeout=60)
-                    if result.photo:
-                        try:
-                            file = asyncio.run_coroutine_threadsafe(
-                                bot.get_file(result.photo[-1].file_id), loop
-                            ).result(timeout=30)
-                            if file.file_path.startswith('http'):
-                                file_url = file.file_path
-                            else:
-                                file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-                            
-                            original_filename = files[0].filename if files else None
-                            original_mimetype = files[0].mimetype if files else None
-                            is_gif = is_gif_file(file.file_path, mimetype=original_mimetype, original_filename=original_filename)
-                            
-                            if is_gif:
-                                save_message(user_id, 'admin', f'[gif]{file_url}')
-                            else:
-                                save_message(user_id, 'admin', f'[image]{file_url}')
-                        except Exception as e:
-                            print(f"Error processing single image: {e}")
-                            save_message(user_id, 'admin', f'[image]sent')
-                elif isinstance(media, InputMediaVideo):
+                elif isinstance(item, InputMediaVideo):
                     print('Sending single video...')
-                    fut = asyncio.run_coroutine_threadsafe(
-                        bot.send_video(chat_id=int(user_id), video=media.media), loop
+                    fut = outbound.submit(
+                        bot.send_video(chat_id=int(user_id), video=item.media)
                     )
-                    result = fut.result(timeout=60)
-                    if result.video:
-                        try:
-                            file = asyncio.run_coroutine_threadsafe(
-                                bot.get_file(result.video.file_id), loop
-                            ).result(timeout=30)
-                            if file.file_path.startswith('http'):
-                                file_url = file.file_path
-                            else:
-                                file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-                            save_message(user_id, 'admin', f'[video]{file_url}')
-                        except Exception as e:
-                            print(f"Error processing single video: {e}")
-                            save_message(user_id, 'admin', f'[video]sent')
-                elif isinstance(media, InputMediaAudio):
+                else:
                     print('Sending single audio...')
-                    fut = asyncio.run_coroutine_threadsafe(
-                        bot.send_audio(chat_id=int(user_id), audio=media.media), loop
+                    fut = outbound.submit(
+                        bot.send_audio(chat_id=int(user_id), audio=item.media)
                     )
-                    result = fut.result(timeout=60)
-                    if result.audio:
-                        try:
-                            file = asyncio.run_coroutine_threadsafe(
-                                bot.get_file(result.audio.file_id), loop
-                            ).result(timeout=30)
-                            if file.file_path.startswith('http'):
-                                file_url = file.file_path
-                            else:
-                                file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-                            save_message(user_id, 'admin', f'[audio]{file_url}')
-                        except Exception as e:
-                            print(f"Error processing single audio: {e}")
-                            save_message(user_id, 'admin', f'[audio]sent')
+                result = [fut.result(timeout=60)]
+            else:
+                result = []
+            if result:
+                record_admin_media(user_id, result, media_files)
                 sent = True
         except Exception as e:
             print(f"Telegram file send error: {e}")
             traceback.print_exc()
             return jsonify({'status': 'error', 'message': f'Failed to send media: {str(e)}'}), 500
         finally:
-            for temp_path in temp_paths:
-                try:
-                    os.remove(temp_path)
-                except Exception as e:
-                    print('Error removing temp file:', temp_path, e)
-
-    # Emit socket event and return response
-    socketio.emit('new_message', {'user_id': user_id}, room='chat_' + str(user_id))
-    socketio.emit('admin_message_sent', {'user_id': user_id}, room='chat_' + str(user_id))
-    
+            for file in files:
+                file.close()
+
+    # Dashboard events for the saved messages were published above
     if sent:
         return jsonify({'status': 'success', 'message': 'Message sent successfully'}), 200
     else:
@@ -768,64 +668,94 @@ def send_one():
     if not user_id or not message:
         return {'status': 'error', 'msg': 'Missing user_id or message'}, 400
     save_message(int(user_id), 'admin', message)
+    events.message(int(user_id), 'admin', message)
     try:
-        asyncio.run_coroutine_threadsafe(
-            bot.send_message(chat_id=int(user_id), text=message), loop
+        outbound.submit(
+            bot.send_message(chat_id=int(user_id), text=message)
         )
     except Exception as e:
         print(f"Telegram send error: {e}")
-    socketio.emit('new_message', {'user_id': int(user_id)}, room='chat_' + str(user_id))
-    socketio.emit('admin_message_sent', {'user_id': int(user_id)}, room='chat_' + str(user_id))
     return {'status': 'ok'}
 
+broadcasts = BroadcastEngine(outbound, on_batch=events.broadcast)
+
 @app.route('/send_all', methods=['POST'])
 def send_all():
     message = request.form.get('message')
     if not message:
         return {'status': 'error', 'msg': 'Missing message'}, 400
-    users = get_all_users()
-    for u in users:
-        save_message(u[0], 'admin', message)
-        try:
-            asyncio.run_coroutine_threadsafe(
-                bot.send_message(chat_id=int(u[0]), text=message), loop
-            )
-        except Exception as e:
-            print(f"Telegram send error: {e}")
-        socketio.emit('new_message', {'user_id': u[0]}, room='chat_' + str(u[0]))
-        socketio.emit('admin_message_sent', {'user_id': u[0]}, room='chat_' + str(u[0]))
-    return {'status': 'ok', 'count': len(users)}
+    user_ids = get_all_user_ids()
+    # Sending happens in the background; poll /send_all/<job_id> for progress
+    job = broadcasts.start(message, user_ids)
+    return {'status': 'ok', 'count': len(user_ids), 'job_id': job.id}, 202
+
+@app.route('/send_all/<job_id>')
+def send_all_status(job_id):
+    job = broadcasts.get(job_id)
+    if job is None:
+        return {'status': 'error', 'msg': 'Unknown job_id'}, 404
+    return jsonify(job.to_dict())
 
 @app.route('/user/<int:user_id>/label', methods=['POST'])
-def set_user_label(user_id):
+def update_user_label(user_id):
     label = request.json.get('label')
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('UPDATE users SET label = ? WHERE user_id = ?', (label, user_id))
-    conn.commit()
-    conn.close()
+    set_user_label(user_id, label)
     return jsonify({'status': 'ok', 'user_id': user_id, 'label': label})
 
+@socketio.on('connect')
+def on_connect():
+    # Every dashboard gets the coalesced dashboard_update summaries
+    join_room(ADMIN_ROOM)
+    events.join(request.sid, ADMIN_ROOM)
+
 @socketio.on('join')
 def on_join(data):
     room = data.get('room')
     join_room(room)
+    events.join(request.sid, room)
+
+@socketio.on('disconnect')
+def on_disconnect():
+    events.disconnect(request.sid)
+
+# After startup, run broadcasts that are queued or were interrupted by a
+# restart (and keep watching for new ones), approve join requests that
+# piled up while the bot was down and index messages older than the search
+# index, and publish the join queue metrics for the web workers. These run
+# wherever the bots run.
+startup_tasks = [
+    broadcasts.watch,
+    join_pipeline.publish,
+    lambda: asyncio.to_thread(backfill_search_index),
+]
+
+async def catch_up_join_requests():
+    # Listing pending requests needs a user account (a chat admin's session)
+    lister = catch_up_client(config.API_ID, config.API_HASH, getattr(config, 'CATCH_UP_SESSION_STRING', None))
+    if lister is None:
+        print("CATCH_UP_SESSION_STRING is not set: join requests sent while offline are not caught up")
+        return
+    async with lister:
+        await join_pipeline.catch_up(pyro_app, lister)
+
+if join_pipeline.backend == BACKEND_MTPROTO:
+    startup_tasks.append(catch_up_join_requests)
+runtime = BotRuntime(outbound, application, pyro_app, background=startup_tasks)
+
+follower = DatabaseFollower(stats.engine, presence)
+
+def follow_database():
+    """Web worker setup when the bots run in bot_runner.py (called from gunicorn.conf.py)"""
+    # Presence transitions are pushed by the bot process; here they only feed reads
+    presence.on_change = None
+    # Broadcasts are queued here and sent by the bot process
+    broadcasts.run_jobs = False
+    follower.start(get_connection)
 
 if __name__ == '__main__':
-    # Start Flask-SocketIO in a thread
-    flask_thread = Thread(target=lambda: socketio.run(app, port=5001, debug=False, allow_unsafe_werkzeug=True), daemon=True)
-    flask_thread.start()
-
-    # Start Telegram bot (for user messages) in a thread
-    def run_telegram_bot():
-        print("Telegram bot running and waiting for user messages...")
-        import asyncio
-        asyncio.set_event_loop(asyncio.new_event_loop())
-        application.run_polling()
-
-    telegram_thread = Thread(target=run_telegram_bot, daemon=True)
-    telegram_thread.start()
-
-    # Start Pyrogram bot in main thread (for join requests)
-    print("Pyrogram bot running and waiting for join requests...")
-    pyro_app.run() 
+    # Bots run on the shared outbound loop; the web server runs in the main thread
+    runtime.start()
+    try:
+        socketio.run(app, port=5001, debug=False, allow_unsafe_werkzeug=True)
+    finally:
+        runtime.stop()
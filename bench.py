@@ -0,0 +1,369 @@
+# Micro-benchmarks for the database layer.
+# Runs against a throwaway database so users.db is never touched.
+#
+#   python bench.py db
+#   python bench.py explain
+#   python bench.py writer
+#   python bench.py events
+#   python bench.py pagination
+#   python bench.py presence
+#   python bench.py search=<messages>   (default 10M; seeding takes a while)
+#   python bench.py load=<workers>      (e.g. load=1,2,4; starts gunicorn per count)
+#   python bench.py catch-up=<pending>  (join request catch-up against fake clients)
+
+import http.client
+import multiprocessing
+import os
+import subprocess
+import sys
+import sqlite3
+import tempfile
+import time
+
+import db
+
+
+def _timed(fn, n):
+    start = time.perf_counter()
+    for i in range(n):
+        fn(i)
+    return (time.perf_counter() - start) / n * 1e6  # microseconds per call
+
+
+def _use_temp_db():
+    tmpdir = tempfile.mkdtemp(prefix='bench_')
+    db.close_all()
+    db.DB_NAME = os.path.join(tmpdir, 'bench.db')
+    db.init_db()
+    return db.DB_NAME
+
+
+def bench_db(n=2000):
+    """Per-call cost of the old connect-per-call helpers vs the pooled layer"""
+    path = _use_temp_db()
+
+    def legacy_save(i):
+        conn = sqlite3.connect(path)
+        c = conn.cursor()
+        c.execute('INSERT INTO messages (user_id, sender, message, timestamp) VALUES (?, ?, ?, ?)',
+                  (i % 50, 'user', 'hello', '2024-01-01 00:00:00'))
+        conn.commit()
+        conn.close()
+
+    def legacy_count(i):
+        conn = sqlite3.connect(path)
+        c = conn.cursor()
+        c.execute('SELECT COUNT(*) FROM users')
+        c.fetchone()
+        conn.close()
+
+    def pooled_save(i):
+        db.save_message(i % 50, 'user', 'hello', '2024-01-01 00:00:00')
+
+    def pooled_count(i):
+        db.get_total_users()
+
+    # Legacy numbers are taken in rollback-journal mode, like the old code ran.
+    db.close_all()
+    with sqlite3.connect(path) as conn:
+        conn.execute('PRAGMA journal_mode=DELETE')
+    results = [
+        ('save_message (connect per call)', _timed(legacy_save, n)),
+        ('get_total_users (connect per call)', _timed(legacy_count, n)),
+    ]
+    results += [
+        ('save_message (pooled)', _timed(pooled_save, n)),
+        ('get_total_users (pooled)', _timed(pooled_count, n)),
+    ]
+    for name, us in results:
+        print(f"{name:<40} {us:8.1f} us/call")
+
+
+def _seed(users, messages, recent_every=10):
+    """Fill the temp DB with synthetic users and messages"""
+    import datetime
+    now = datetime.datetime.now()
+    old = (now - datetime.timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S')
+    fresh = now.strftime('%Y-%m-%d %H:%M:%S')
+    with db.get_connection() as conn:
+        conn.executemany('INSERT INTO users (user_id, full_name, username, join_date) VALUES (?, ?, ?, ?)',
+                         ((u, f'User {u}', f'user{u}', old) for u in range(users)))
+        conn.executemany('INSERT INTO messages (user_id, sender, message, timestamp) VALUES (?, ?, ?, ?)',
+                         ((i % users, 'user', f'message {i}', fresh if i % users % recent_every == 0 else old)
+                          for i in range(messages)))
+
+
+def bench_explain():
+    """Fail unless every dashboard query is served by an index"""
+    _use_temp_db()
+    _seed(200, 2000)
+    with db.get_connection() as conn:
+        conn.execute('ANALYZE')
+    failed = False
+    for name, (ok, plan) in db.check_query_plans().items():
+        print(f"{'ok  ' if ok else 'FAIL'} {name:<24} {' | '.join(plan)}")
+        failed = failed or not ok
+    if failed:
+        sys.exit(1)
+
+
+def bench_writer(n=5000):
+    """Caller-side cost of save_message: direct commit vs write-behind queue"""
+    import message_writer
+    _use_temp_db()
+    direct = _timed(lambda i: db.save_message(i % 50, 'user', 'hello'), n)
+    writer = message_writer.MessageWriter()
+    queued = _timed(lambda i: writer.enqueue(i % 50, 'user', 'hello'), n)
+    start = time.perf_counter()
+    writer.stop()
+    drain = (time.perf_counter() - start) * 1000
+    print(f"save_message direct commit   {direct:8.1f} us/call")
+    print(f"save_message write-behind    {queued:8.1f} us/call (final flush {drain:.1f} ms)")
+    print(f"rows in DB: {db.get_total_messages()} (expected {2 * n})")
+
+
+def bench_events(users=20000, open_chats=3):
+    """Socket.IO emits for one broadcast: per-user emits vs the coalescing event bus"""
+    from events import EventBus, ADMIN_ROOM
+
+    class CountingSocketIO:
+        emits = 0
+
+        def emit(self, event, data, room=None):
+            self.emits += 1
+
+    rows = [(user_id, 'admin', 'hello', None) for user_id in range(users)]
+    # Before: two emits per recipient, into rooms nobody may have open
+    legacy = 2 * users
+    print(f"per-recipient emits          {legacy:8d}")
+    for label, track_rooms in (('event bus emits', True), ('  behind a message queue', False)):
+        sio = CountingSocketIO()
+        bus = EventBus(sio, window=60, track_rooms=track_rooms)  # flushed explicitly below
+        bus.join('dashboard', ADMIN_ROOM)
+        for user_id in range(open_chats):
+            bus.join('dashboard', f'chat_{user_id}')
+        start = time.perf_counter()
+        for i in range(0, users, 200):  # one on_batch per broadcast checkpoint
+            bus.broadcast(rows[i:i + 200])
+        bus.flush()
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f"{label:28s} {sio.emits:8d} ({elapsed:.1f} ms to publish and flush)")
+
+
+def bench_pagination(users=200000, page_size=50):
+    """Deep /dashboard-users pages: LIMIT/OFFSET vs keyset on (join_date, user_id)"""
+    _use_temp_db()
+    with db.get_connection() as conn:
+        conn.executemany('INSERT INTO users (user_id, full_name, username, join_date) VALUES (?, ?, ?, ?)',
+                         ((u, f'User {u}', f'user{u}', f'2024-01-01 00:{u // 6000 % 60:02d}:{u // 100 % 60:02d}')
+                          for u in range(users)))
+    for depth in (0, users // 10, users // 2, users - page_size):
+        offset = _timed(lambda i: db.get_users_page(page_size, depth), 20)
+        row = db.get_users_page(1, depth - 1)[0] if depth else None
+        keyset = _timed(lambda i: db.get_users_after(page_size, row and row[3], row and row[0]), 20)
+        assert db.get_users_page(page_size, depth) == db.get_users_after(page_size, row and row[3], row and row[0])
+        print(f"page at row {depth:7d}   offset {offset:9.1f} us   keyset {keyset:7.1f} us")
+
+
+def bench_search(messages=10_000_000, users=20000):
+    """/search over a synthetic corpus: FTS5 MATCH vs a LIKE '%term%' scan"""
+    import random
+    messages = int(messages)
+    _use_temp_db()
+    rng = random.Random(42)
+    vocabulary = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 9)))
+                  for _ in range(20000)]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]  # Zipf-like word frequencies
+    start = time.perf_counter()
+    for offset in range(0, messages, 100000):
+        words = rng.choices(vocabulary, weights, k=min(100000, messages - offset) * 8)
+        with db.get_connection() as conn:
+            conn.executemany('INSERT INTO messages (user_id, sender, message, timestamp) VALUES (?, ?, ?, ?)',
+                             ((rng.randrange(users), 'user', ' '.join(words[i * 8:i * 8 + rng.randint(3, 8)]), '2024-01-01 00:00:00')
+                              for i in range(len(words) // 8)))
+    print(f"seeded {messages} messages (indexed by triggers) in {time.perf_counter() - start:.0f} s")
+    rare, common = vocabulary[5000], vocabulary[10]
+    for label, text, user_id in (('rare word', rare, None), ('common word', common, None),
+                                 ('prefix', rare[:3], None), ('no match', 'zzzzzzzzzz', None),
+                                 ('rare word, one user', rare, 7), ('common word, one user', common, 7)):
+        fts = _timed(lambda i: db.search_messages(text, user_id, 20), 5) / 1000
+        with db.get_connection() as conn:
+            sql = 'SELECT id FROM messages WHERE message LIKE ?' + (' AND user_id = ?' if user_id is not None else '') + ' LIMIT 20'
+            params = (f'%{text}%',) + ((user_id,) if user_id is not None else ())
+            like = _timed(lambda i: conn.execute(sql, params).fetchall(), 1) / 1000
+        print(f"{label:20s} fts {fts:8.2f} ms   like {like:9.2f} ms")
+
+
+def bench_presence(users=20000, messages=200000, page_size=100):
+    """Online status for a /dashboard-users page: messages-table query vs the presence tracker"""
+    import datetime
+    from presence import PresenceTracker
+    _use_temp_db()
+    _seed(users, messages)
+    tracker = PresenceTracker()
+    tracker._thread = True  # no expiry thread needed here
+    start = time.perf_counter()
+    with db.get_connection() as conn:
+        tracker.warm_up(conn)
+    warm = (time.perf_counter() - start) * 1000
+    ids = list(range(page_size))
+    since = (datetime.datetime.now() - datetime.timedelta(minutes=5)).strftime('%Y-%m-%d %H:%M:%S')
+    page_sql = f"SELECT DISTINCT user_id FROM messages WHERE timestamp >= ? AND sender = 'user' AND user_id IN ({','.join('?' * page_size)})"
+    one_sql = "SELECT 1 FROM messages WHERE user_id = ? AND timestamp >= ? AND sender = 'user' LIMIT 1"
+    with db.get_connection() as conn:
+        query = _timed(lambda i: conn.execute(page_sql, (since, *ids)).fetchall(), 50)
+        single = _timed(lambda i: conn.execute(one_sql, (i % users, since)).fetchone(), 500)
+        online = {row[0] for row in conn.execute(page_sql, (since, *ids))}
+    in_memory = _timed(lambda i: tracker.online_ids(ids), 50)
+    lookup = _timed(lambda i: tracker.is_online(i % users), 500)
+    assert tracker.online_ids(ids) == online
+    print(f"warm-up: {tracker.online_count()} users online, {warm:.1f} ms")
+    print(f"page of {page_size}: query {query:8.1f} us   tracker {in_memory:6.1f} us")
+    print(f"one user:     query {single:8.1f} us   tracker {lookup:6.1f} us")
+
+
+def bench_catch_up(pending=450):
+    """Join request catch-up against fake Pyrogram clients, with one FloodWait"""
+    import asyncio
+    from types import SimpleNamespace
+    from join_requests import JoinRequestPipeline, BACKEND_MTPROTO
+    pending = int(pending)
+    _use_temp_db()
+
+    class FloodWait(Exception):
+        value = 1
+
+    class FakeBot:
+        """Bot session: may approve and message, but has no listing call"""
+        approved, messaged, flooded = set(), [], False
+
+        async def get_chat(self, chat_id):
+            return SimpleNamespace(id=chat_id, title='Test chat')
+
+        async def approve_chat_join_request(self, chat_id, user_id):
+            if not self.flooded and len(self.approved) == pending // 2:
+                self.flooded = True
+                raise FloodWait()
+            self.approved.add(user_id)
+
+        async def send_message(self, user_id, text):
+            self.messaged.append(user_id)
+
+    class FakeUser:
+        async def get_chat_join_requests(self, chat_id):
+            for i in range(pending):
+                user = SimpleNamespace(id=i, first_name='User', last_name=str(i), username=f'user{i}', mention=f'@user{i}')
+                yield SimpleNamespace(user=user, date=i)
+
+    async def run():
+        pipeline = JoinRequestPipeline(BACKEND_MTPROTO, chat_id=-100)
+        pipeline.scheduler.rate = 1000
+        bot = FakeBot()
+        start = time.perf_counter()
+        progress = await pipeline.catch_up(bot, FakeUser())
+        while len(bot.messaged) < len(bot.approved) and time.perf_counter() - start < 60:
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - start
+        print(f"catch-up {progress['status']}: {progress['approved']} approved, {progress['stored']} stored, "
+              f"{len(bot.messaged)} welcomed, {pipeline.scheduler.counters['flood_waits']} flood waits, {elapsed:.1f} s")
+        assert progress['status'] == 'done' and progress['approved'] == progress['stored'] == pending
+        assert len(bot.approved) == len(set(bot.messaged)) == pending
+        assert db.get_user(pending - 1) is not None
+
+    asyncio.run(run())
+
+
+LOAD_PATHS = (
+    '/dashboard-stats',
+    '/dashboard-users?page_size=50',
+    '/users?q=user12&page_size=50',
+    '/user-status/{user_id}',
+)
+
+
+def _load_client(port, users, seconds, results):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    done = errors = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        path = LOAD_PATHS[done % len(LOAD_PATHS)].format(user_id=done % users)
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        done += 1
+    results.put((done, errors))
+
+
+def _wait_ready(port, server, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError('gunicorn exited during startup')
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/dashboard-stats')
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError('gunicorn did not become ready')
+
+
+def bench_load(workers='1,2,4', seconds=10, clients=16, users=20000, messages=200000):
+    """Dashboard API throughput for each gunicorn worker count (bots not started)"""
+    path = _use_temp_db()
+    _seed(users, messages)
+    db.close_all()
+    env = dict(os.environ, DB_PATH=path, MEDIA_ACCEL_REDIRECT='')
+    port = 5900
+    for count in [int(w) for w in str(workers).split(',')]:
+        port += 1
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}',
+             '--workers', str(count), '--log-level', 'warning', 'api:app'],
+            env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        try:
+            _wait_ready(port, server)
+            results = multiprocessing.Queue()
+            procs = [multiprocessing.Process(target=_load_client, args=(port, users, seconds, results))
+                     for _ in range(clients)]
+            for proc in procs:
+                proc.start()
+            totals = [results.get() for _ in procs]
+            for proc in procs:
+                proc.join()
+        finally:
+            server.terminate()
+            server.wait()
+        done = sum(t[0] for t in totals)
+        errors = sum(t[1] for t in totals)
+        print(f"{count:2d} workers: {done / seconds:8.0f} req/s   ({errors} errors, {clients} clients, {os.cpu_count()} CPUs)")
+
+
+BENCHMARKS = {
+    'db': bench_db,
+    'explain': bench_explain,
+    'writer': bench_writer,
+    'events': bench_events,
+    'pagination': bench_pagination,
+    'presence': bench_presence,
+    'search': bench_search,
+    'load': bench_load,
+    'catch-up': bench_catch_up,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        name, _, arg = name.partition('=')
+        print(f"== {name} ==")
+        BENCHMARKS[name](*([arg] if arg else []))
@@ -0,0 +1,30 @@
+# Runs the Telegram bots (PTB polling, Pyrogram join requests, broadcasts and
+# the startup jobs) in their own process, so the dashboard API can run as
+# several gunicorn workers without each of them polling Telegram.
+#
+#   python bot_runner.py
+#
+# Set SOCKETIO_MESSAGE_QUEUE to the same URL as the web workers so the
+# dashboard events emitted here reach their Socket.IO clients.
+
+import signal
+import threading
+
+import api
+
+
+def main():
+    if api.MESSAGE_QUEUE is None:
+        print("SOCKETIO_MESSAGE_QUEUE is not set: dashboard events from the bots will not reach the web workers")
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stop.set())
+    api.runtime.start()
+    try:
+        stop.wait()
+    finally:
+        api.runtime.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+import asyncio
+import datetime
+import threading
+import time
+import uuid
+
+from telegram.error import Forbidden, BadRequest, RetryAfter, TimedOut, NetworkError
+
+from ratelimit import TokenBucket
+from db import (
+    create_broadcast_job, get_broadcast_job, get_unfinished_broadcast_jobs, set_broadcast_job_status,
+    get_broadcast_counts, get_pending_recipients, record_broadcast_results,
+)
+
+# Telegram allows ~30 messages/second overall and ~1 message/second per chat
+GLOBAL_RATE = 28
+PER_CHAT_INTERVAL = 1.0
+MAX_CONCURRENCY = 20
+MAX_RETRIES = 3
+CHUNK_SIZE = 2000       # recipients loaded from the DB at a time
+CHECKPOINT_SIZE = 200   # results committed per transaction
+WATCH_INTERVAL = 2.0    # seconds between checks for jobs queued by other processes
+
+class BroadcastJob:
+    """Progress of one broadcast. The database is the source of truth;
+    these counters are a cache refreshed from it on resume."""
+
+    def __init__(self, job_id, message, status='queued', created_at=None, counts=None):
+        self.id = job_id
+        self.message = message
+        self.status = status
+        self.created_at = created_at or datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.counts = {'pending': 0, 'sent': 0, 'failed': 0, 'blocked': 0}
+        self.counts.update(counts or {})
+        self.errors = {}
+        self.started = None
+        self.finished = None
+        self._sent_at_start = 0
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def record(self, state, error=None):
+        self.counts['pending'] -= 1
+        self.counts[state] += 1
+        if error:
+            self.errors[error] = self.errors.get(error, 0) + 1
+
+    def to_dict(self):
+        elapsed = ((self.finished or time.monotonic()) - self.started) if self.started else 0
+        sent_this_run = self.counts['sent'] - self._sent_at_start
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'total': self.total,
+            'sent': self.counts['sent'],
+            'failed': self.counts['failed'] + self.counts['blocked'],
+            'blocked': self.counts['blocked'],
+            'pending': self.counts['pending'],
+            'created_at': self.created_at,
+            'elapsed_seconds': round(elapsed, 1),
+            'messages_per_second': round(sent_this_run / elapsed, 1) if elapsed else 0.0,
+            'errors': dict(self.errors),
+        }
+
+class BroadcastEngine:
+    """Runs /send_all broadcasts in the background under Telegram's rate limits.
+
+    Jobs and per-recipient state live in SQLite (broadcast_jobs and
+    broadcast_recipients), so resume() can pick up unfinished jobs after a
+    restart without messaging anyone twice. Progress is checkpointed every
+    CHECKPOINT_SIZE recipients together with the outgoing message rows.
+
+    Jobs run as tasks on the OutboundTelegram loop and share its Bot and
+    one token bucket, so concurrent jobs together stay under GLOBAL_RATE
+    and a RetryAfter in one pauses all of them.
+    on_batch(message_rows) is called with the (user_id, sender, message,
+    timestamp) rows saved at each checkpoint, so the caller can notify
+    dashboards.
+
+    Only one process may run jobs. With run_jobs=False (the API workers
+    when the bots run in bot_runner.py) start() only inserts a queued job,
+    and the process running watch() picks it up.
+    """
+
+    def __init__(self, outbound, on_batch=None, run_jobs=True):
+        self.outbound = outbound
+        self.on_batch = on_batch
+        self.run_jobs = run_jobs
+        self.jobs = {}
+        self._bucket = None  # created on the outbound loop by the first job
+        self._last_sent = {}
+        self._last_sent_lock = threading.Lock()
+
+    def start(self, message, user_ids):
+        job_id = uuid.uuid4().hex
+        job = BroadcastJob(job_id, message)
+        if self.run_jobs:
+            # Registered before the queued row is committed, so a watch()
+            # tick in between does not launch the job a second time
+            self.jobs[job_id] = job
+        try:
+            create_broadcast_job(job_id, message, user_ids)
+        except Exception:
+            self.jobs.pop(job_id, None)
+            raise
+        job.counts.update(get_broadcast_counts(job_id))
+        if self.run_jobs:
+            self._launch(job)
+        return job
+
+    def resume(self):
+        """Run every queued job, and every running one left by a previous process"""
+        resumed = []
+        for job_id, message, status, created_at, _ in get_unfinished_broadcast_jobs():
+            if job_id in self.jobs:
+                continue
+            job = BroadcastJob(job_id, message, status, created_at, get_broadcast_counts(job_id))
+            print(f"Running broadcast {job_id} ({status}): {job.counts['pending']} recipients pending")
+            self._launch(job)
+            resumed.append(job)
+        return resumed
+
+    async def watch(self, interval=WATCH_INTERVAL):
+        """resume() now and then every interval, picking up jobs queued by the API workers"""
+        while True:
+            try:
+                await asyncio.to_thread(self.resume)
+            except Exception as e:
+                print(f"Broadcast watch failed: {e}")
+            await asyncio.sleep(interval)
+
+    def get(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            row = get_broadcast_job(job_id)
+            if row is not None:
+                job = BroadcastJob(row[0], row[1], row[2], row[3], get_broadcast_counts(job_id))
+        return job
+
+    def _launch(self, job):
+        self.jobs[job.id] = job
+        self.outbound.submit(self._run(job))
+
+    async def _run(self, job):
+        job.status = 'running'
+        job.started = time.monotonic()
+        job._sent_at_start = job.counts['sent']
+        await asyncio.to_thread(set_broadcast_job_status, job.id, 'running')
+        if self._bucket is None:
+            self._bucket = TokenBucket(GLOBAL_RATE)
+        bucket = self._bucket
+        results = []
+        bot = self.outbound.bot
+        try:
+            while True:
+                chunk = await asyncio.to_thread(get_pending_recipients, job.id, CHUNK_SIZE)
+                if not chunk:
+                    break
+                queue = asyncio.Queue()
+                for user_id in chunk:
+                    queue.put_nowait(user_id)
+                workers = [asyncio.create_task(self._worker(job, bot, bucket, queue, results))
+                           for _ in range(min(MAX_CONCURRENCY, len(chunk)))]
+                try:
+                    await asyncio.gather(*workers)
+                except BaseException:
+                    # Stop the other workers before the job is marked failed:
+                    # empty the queue so each finishes its current send (and
+                    # records it), then wait for them
+                    while not queue.empty():
+                        queue.get_nowait()
+                    await asyncio.gather(*workers, return_exceptions=True)
+                    raise
+                # Everything from this chunk must be checkpointed before
+                # the next pending query, or it would be picked up again
+                await self._checkpoint(job, results)
+            job.status = 'done'
+        except Exception as e:
+            print(f"Broadcast {job.id} aborted: {e}")
+            job.status = 'error'
+        finally:
+            try:
+                await self._checkpoint(job, results)
+            except Exception:
+                # Those recipients stay pending; resume() retries them
+                job.status = 'error'
+            await asyncio.to_thread(set_broadcast_job_status, job.id, job.status, job.status == 'done')
+            job.finished = time.monotonic()
+            print(f"Broadcast {job.id} finished: {job.to_dict()}")
+
+    async def _worker(self, job, bot, bucket, queue, results):
+        while True:
+            try:
+                user_id = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            state, error = await self._send(job, bot, bucket, user_id)
+            job.record(state, error)
+            results.append((user_id, state, error))
+            if len(results) >= CHECKPOINT_SIZE:
+                await self._checkpoint(job, results)
+
+    async def _send(self, job, bot, bucket, user_id):
+        """Send to one chat; returns (state, error)"""
+        for attempt in range(MAX_RETRIES + 1):
+            await self._wait_for_chat(user_id)
+            await bucket.acquire()
+            try:
+                await bot.send_message(chat_id=int(user_id), text=job.message)
+                return 'sent', None
+            except RetryAfter as e:
+                # Flood control applies to the whole bot, so stop every worker
+                bucket.pause(e.retry_after)
+            except Forbidden:
+                return 'blocked', 'forbidden'
+            except BadRequest as e:
+                return 'failed', f'bad_request: {e.message}'
+            except (TimedOut, NetworkError):
+                await asyncio.sleep(min(2 ** attempt, 30))
+        return 'failed', 'retries_exhausted'
+
+    async def _wait_for_chat(self, user_id):
+        """Keep at least PER_CHAT_INTERVAL between sends to one chat, across jobs"""
+        with self._last_sent_lock:
+            now = time.monotonic()
+            next_slot = max(now, self._last_sent.get(user_id, 0.0) + PER_CHAT_INTERVAL)
+            self._last_sent[user_id] = next_slot
+            # Drop entries that can no longer delay anyone
+            if len(self._last_sent) > 100000:
+                self._last_sent = {k: v for k, v in self._last_sent.items() if v > now - PER_CHAT_INTERVAL}
+        if next_slot > now:
+            await asyncio.sleep(next_slot - now)
+
+    async def _checkpoint(self, job, results):
+        if not results:
+            return
+        batch = list(results)
+        results.clear()
+        message_rows = [(user_id, 'admin', job.message, None) for user_id, state, _ in batch if state == 'sent']
+        try:
+            await asyncio.to_thread(record_broadcast_results, job.id, batch, message_rows)
+        except Exception as e:
+            # Stop the job rather than re-fetching recipients that were
+            # already messaged. The job ends as 'error', which resume()
+            # picks up again on the next start; unsaved rows are retried
+            # by the final checkpoint in _run
+            print(f"Broadcast {job.id} checkpoint failed for {len(batch)} recipients: {e}")
+            results[:0] = batch
+            raise
+        if self.on_batch and message_rows:
+            self.on_batch(message_rows)
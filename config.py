@@ -16,6 +16,18 @@ GROUP_INVITE_LINK = 'https://t.me/+mEcMgPqw3xphODM1'  # Replace with your actual
 API_ID = "25842851"
 API_HASH = "4fcbc414da34a43d86eca15e1235d2ae"
 CHAT_ID = "-1002286109418"  # Channel/Group ID (negative sign সহ)
+JOIN_REQUEST_BACKEND = "mtproto"  # "mtproto" (Pyrogram) or "botapi" (python-telegram-bot)
+# Session string of a chat admin's user account (Client.export_session_string());
+# only users can list pending join requests, so the startup catch-up needs it
+CATCH_UP_SESSION_STRING = None
+
+# Public base URL of the API, used for media links in the dashboard
+# (behind the bundled nginx: "https://your-domain.com/api/"; env PUBLIC_API_URL wins)
+PUBLIC_API_URL = "http://localhost:5001/"
+
+# Dashboard media cache (files downloaded from Telegram on first view)
+MEDIA_PATH = "./media"
+MEDIA_CACHE_MAX_BYTES = 2 * 1024 ** 3
 
 WELCOME_TEXT = "👋 Welcome to our Telegram group!\n\nWe're excited to have you join our community. Here you can connect, share, and learn with others.\n\nPlease be respectful and follow the group guidelines. If you have any questions, feel free to ask.\n\nEnjoy your stay!"
 
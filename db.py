@@ -1,67 +1,611 @@
+import os
 import sqlite3
 import datetime
+import queue
+import re
+from contextlib import contextmanager
 
-DB_NAME = 'users.db'
+import stats
+
+DB_NAME = os.environ.get('DB_PATH', 'users.db')
+
+# --- Connection pool ---
+# Connections are long-lived and shared by the Flask thread and the bot
+# threads. Each one is borrowed for the duration of a call and returned to
+# the pool afterwards, so the file open, schema parse and pragma setup only
+# happen once per connection instead of once per query.
+POOL_SIZE = 8
+STATEMENT_CACHE_SIZE = 256
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA mmap_size=268435456',  # 256MB
+    'PRAGMA cache_size=-16000',    # 16MB
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA busy_timeout=5000',
+)
+
+_pool = queue.LifoQueue(maxsize=POOL_SIZE)
+
+def _connect():
+    conn = sqlite3.connect(
+        DB_NAME,
+        timeout=5,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE,
+    )
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+@contextmanager
+def get_connection():
+    """Borrow a pooled connection. Commits on success, rolls back on error."""
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = _connect()
+    try:
+        with conn:
+            yield conn
+    finally:
+        try:
+            _pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+def close_all():
+    """Close every idle pooled connection (used on shutdown and in benchmarks)."""
+    while True:
+        try:
+            conn = _pool.get_nowait()
+        except queue.Empty:
+            break
+        conn.close()
 
 def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS users (
-        user_id INTEGER PRIMARY KEY,
-        full_name TEXT,
-        username TEXT,
-        join_date TEXT,
-        invite_link TEXT,
-        photo_url TEXT,
-        label TEXT
-    )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS messages (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        sender TEXT,
-        message TEXT,
-        timestamp TEXT
-    )''')
-    conn.commit()
-    conn.close()
-
-def add_user(user_id, full_name, username, join_date, invite_link=None, photo_url=None):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('INSERT OR IGNORE INTO users (user_id, full_name, username, join_date, invite_link, photo_url) VALUES (?, ?, ?, ?, ?, ?)', (user_id, full_name, username, join_date, invite_link, photo_url))
-    c.execute('UPDATE users SET invite_link = ?, photo_url = ? WHERE user_id = ?', (invite_link, photo_url, user_id))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            full_name TEXT,
+            username TEXT,
+            join_date TEXT,
+            invite_link TEXT,
+            photo_url TEXT,
+            label TEXT
+        )''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            sender TEXT,
+            message TEXT,
+            timestamp TEXT
+        )''')
+    migrate()
+    with get_connection() as conn:
+        stats.engine.warm_up(conn)
+
+# --- Schema migrations ---
+# Which message rows belong in messages_fts (see migration 5)
+_FTS_INDEXED = "{row}.message IS NOT NULL AND {row}.message NOT LIKE '[%]media:%'"
+_FTS_BACKFILLED = "NOT EXISTS (SELECT 1 FROM search_backfill WHERE {row}.id BETWEEN next_id AND end_id)"
+
+# Each entry upgrades the schema to `version`. Steps are SQL strings or
+# callables taking the connection. The applied version is stored in
+# PRAGMA user_version, so startup only runs what is missing.
+MIGRATIONS = [
+    (1, 'indexes for chat history, online status, stats and dashboard ordering', [
+        'CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages(user_id, id)',
+        'CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp, user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_users_join_date ON users(join_date)',
+    ]),
+    (2, 'persistent broadcast jobs with per-recipient state', [
+        '''CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            job_id TEXT PRIMARY KEY,
+            message TEXT,
+            status TEXT,
+            created_at TEXT,
+            finished_at TEXT
+        )''',
+        '''CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            job_id TEXT,
+            user_id INTEGER,
+            state TEXT DEFAULT 'pending',
+            error TEXT,
+            PRIMARY KEY (job_id, user_id)
+        ) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_state ON broadcast_recipients(job_id, state)',
+    ]),
+    (3, 'media table referenced from messages instead of bot-token file URLs', [
+        '''CREATE TABLE IF NOT EXISTS media (
+            file_unique_id TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            media_type TEXT,
+            file_size INTEGER,
+            mime_type TEXT,
+            file_name TEXT,
+            created_at TEXT
+        )''',
+    ]),
+    (4, 'keyset pagination index for the dashboard user list', [
+        # Rows without a join_date would fall outside every (join_date, user_id) range
+        "UPDATE users SET join_date = '' WHERE join_date IS NULL",
+        'CREATE INDEX IF NOT EXISTS idx_users_join_date_user_id ON users(join_date, user_id)',
+        # Covered by the new index's leading column
+        'DROP INDEX IF EXISTS idx_users_join_date',
+    ]),
+    (5, 'full-text search index over messages', [
+        # External-content FTS5 table: the text lives in messages only.
+        # Media references are not indexed.
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            message, user_id, content='messages', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )''',
+        # Rows that existed before this migration are indexed in chunks by
+        # backfill_search_index(); ids in [next_id, end_id] are not indexed yet
+        '''CREATE TABLE IF NOT EXISTS search_backfill (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            next_id INTEGER,
+            end_id INTEGER
+        )''',
+        'INSERT OR REPLACE INTO search_backfill (id, next_id, end_id) SELECT 1, 1, COALESCE(MAX(id), 0) FROM messages',
+        f'''CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+            WHEN {_FTS_INDEXED.format(row='new')} BEGIN
+            INSERT INTO messages_fts (rowid, message, user_id) VALUES (new.id, new.message, new.user_id);
+        END''',
+        f'''CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+            WHEN {_FTS_INDEXED.format(row='old')} AND {_FTS_BACKFILLED.format(row='old')} BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message, user_id) VALUES ('delete', old.id, old.message, old.user_id);
+        END''',
+        # One trigger so the old text is removed before the new text is added
+        f'''CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message, user_id ON messages
+            WHEN {_FTS_BACKFILLED.format(row='old')} BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message, user_id)
+                SELECT 'delete', old.id, old.message, old.user_id WHERE {_FTS_INDEXED.format(row='old')};
+            INSERT INTO messages_fts (rowid, message, user_id)
+                SELECT new.id, new.message, new.user_id WHERE {_FTS_INDEXED.format(row='new')};
+        END''',
+    ]),
+    (6, 'user filters: trigram name index and label index', [
+        # Substring (and so prefix) search on names; trigram needs 3+ characters
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+            full_name, username, content='users', content_rowid='user_id', tokenize='trigram'
+        )''',
+        "INSERT INTO users_fts (users_fts) VALUES ('rebuild')",
+        '''CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+            INSERT INTO users_fts (rowid, full_name, username) VALUES (new.user_id, new.full_name, new.username);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, full_name, username) VALUES ('delete', old.user_id, old.full_name, old.username);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF full_name, username ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, full_name, username) VALUES ('delete', old.user_id, old.full_name, old.username);
+            INSERT INTO users_fts (rowid, full_name, username) VALUES (new.user_id, new.full_name, new.username);
+        END''',
+        'CREATE INDEX IF NOT EXISTS idx_users_label ON users(label, join_date, user_id)',
+    ]),
+    (7, 'runtime metrics published by the bot process for the web workers', [
+        '''CREATE TABLE IF NOT EXISTS runtime_metrics (
+            name TEXT PRIMARY KEY,
+            value TEXT,
+            updated_at TEXT
+        )''',
+    ]),
+]
+
+def get_schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate():
+    """Apply pending migrations. Safe to call on every startup and from several processes."""
+    with get_connection() as conn:
+        # Take the write lock first so concurrent starters apply each step once
+        conn.execute('BEGIN IMMEDIATE')
+        version = get_schema_version(conn)
+        for target, description, steps in MIGRATIONS:
+            if target <= version:
+                continue
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(f'PRAGMA user_version = {int(target)}')
+            version = target
+            print(f"DB schema migrated to v{target}: {description}")
+    return version
+
+def _now():
+    return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+# --- Queries ---
+# Hot dashboard queries are kept here so check_query_plans() explains
+# exactly the SQL the helpers run.
+SQL_USERS_PAGE = 'SELECT user_id, full_name, username, join_date, invite_link, photo_url, label FROM users ORDER BY join_date DESC, user_id DESC LIMIT ? OFFSET ?'
+SQL_USERS_AFTER = ('SELECT user_id, full_name, username, join_date, invite_link, photo_url, label FROM users '
+                   'WHERE (join_date, user_id) < (?, ?) ORDER BY join_date DESC, user_id DESC LIMIT ?')
+SQL_USERS_QUERY = ('SELECT user_id, full_name, username, join_date, invite_link, photo_url, label FROM users '
+                   'WHERE {where} ORDER BY join_date DESC, user_id DESC LIMIT ?')
+SQL_USERS_COUNT = 'SELECT COUNT(*) FROM users WHERE {where}'
+SQL_NEW_JOINS = 'SELECT COUNT(*) FROM users WHERE join_date >= ? AND join_date < ?'
+MAX_ROWID = 2 ** 63 - 1
+SQL_MESSAGES_BEFORE = 'SELECT id, sender, message, timestamp FROM messages WHERE user_id = ? AND id < ? ORDER BY id DESC LIMIT ?'
+SQL_MESSAGES_AFTER = 'SELECT id, sender, message, timestamp FROM messages WHERE user_id = ? AND id > ? ORDER BY id ASC LIMIT ?'
+SQL_LAST_ACTIVITY = 'SELECT timestamp FROM messages WHERE user_id = ? ORDER BY id DESC LIMIT 1'
+SQL_ACTIVE_USERS = 'SELECT COUNT(DISTINCT user_id) FROM messages WHERE timestamp >= ?'
+
+# --- Users ---
+# join_date is never NULL (migration v4): a NULL would sort outside every
+# keyset page of the user list, so a missing date is stored as ''
+def add_user(user_id, full_name, username, join_date, invite_link=None, photo_url=None, label=None):
+    join_date = join_date or ''
+    with get_connection() as conn:
+        inserted = conn.execute('INSERT OR IGNORE INTO users (user_id, full_name, username, join_date, invite_link, photo_url, label) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                (user_id, full_name, username, join_date, invite_link, photo_url, label)).rowcount
+    if inserted:
+        stats.engine.record_user(join_date)
+
+def save_user_profile(user_id, full_name, username, join_date, photo_url=None):
+    """Insert the user, or refresh name/username (and photo_url when given) of an existing row"""
+    join_date = join_date or ''
+    with get_connection() as conn:
+        inserted = conn.execute('INSERT OR IGNORE INTO users (user_id, full_name, username, join_date, photo_url) VALUES (?, ?, ?, ?, ?)',
+                                (user_id, full_name, username, join_date, photo_url)).rowcount
+        if not inserted:
+            conn.execute('UPDATE users SET full_name = ?, username = ?, photo_url = COALESCE(?, photo_url) WHERE user_id = ?',
+                         (full_name, username, photo_url, user_id))
+    if inserted:
+        stats.engine.record_user(join_date)
+
+def add_users_bulk(rows):
+    """INSERT OR IGNORE many (user_id, full_name, username, join_date, invite_link) rows in one transaction"""
+    rows = [(user_id, full_name, username, join_date or '', invite_link)
+            for user_id, full_name, username, join_date, invite_link in rows]
+    if not rows:
+        return 0
+    placeholders = ','.join('?' * len(rows))
+    with get_connection() as conn:
+        existing = {row[0] for row in conn.execute(f'SELECT user_id FROM users WHERE user_id IN ({placeholders})',
+                                                   [row[0] for row in rows])}
+        conn.executemany('INSERT OR IGNORE INTO users (user_id, full_name, username, join_date, invite_link) VALUES (?, ?, ?, ?, ?)', rows)
+    new_rows = {row[0]: row[3] for row in rows if row[0] not in existing}
+    stats.engine.record_users(new_rows.values())
+    return len(new_rows)
+
+def user_exists(user_id):
+    with get_connection() as conn:
+        return conn.execute('SELECT 1 FROM users WHERE user_id = ?', (user_id,)).fetchone() is not None
+
+def get_user(user_id):
+    with get_connection() as conn:
+        return conn.execute('SELECT full_name, username, photo_url FROM users WHERE user_id = ?', (user_id,)).fetchone()
+
+def set_user_label(user_id, label):
+    with get_connection() as conn:
+        conn.execute('UPDATE users SET label = ? WHERE user_id = ?', (label, user_id))
 
 def get_total_users():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT COUNT(*) FROM users')
-    total = c.fetchone()[0]
-    conn.close()
-    return total
+    with get_connection() as conn:
+        return conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
 
 def get_all_users():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT user_id, full_name, username, join_date, invite_link, photo_url FROM users')
-    users = c.fetchall()
-    conn.close()
-    return users
+    with get_connection() as conn:
+        return conn.execute('SELECT user_id, full_name, username, join_date, invite_link, photo_url, label FROM users').fetchall()
+
+def get_all_user_ids():
+    with get_connection() as conn:
+        return [row[0] for row in conn.execute('SELECT user_id FROM users')]
+
+def get_users_page(limit, offset):
+    with get_connection() as conn:
+        return conn.execute(SQL_USERS_PAGE, (limit, offset)).fetchall()
+
+def get_users_after(limit, join_date=None, user_id=None):
+    """Newest-first page of users strictly after the (join_date, user_id) keyset position.
 
+    Same columns as get_users_page; pass the last row's join_date and
+    user_id to get the next page. Cost does not grow with depth.
+    """
+    if join_date is None:
+        return get_users_page(limit, 0)
+    with get_connection() as conn:
+        return conn.execute(SQL_USERS_AFTER, (join_date, user_id, limit)).fetchall()
+
+def query_users(limit, name=None, label=None, joined_from=None, joined_to=None, active_since=None,
+                has_invite_link=None, after=None):
+    """Filtered, newest-first page of users: returns (rows, total).
+
+    Rows have the get_users_page columns. Every filter is optional and they
+    combine with AND: name matches full_name or username as a substring,
+    joined_from/joined_to bound join_date (inclusive/exclusive), active_since
+    keeps users who sent a message at or after that timestamp. after is the
+    (join_date, user_id) keyset position of the previous page's last row.
+    total counts every match and is only computed for the first page
+    (after is None); later pages are a plain keyset query and return None,
+    so callers carry the first page's total forward.
+    """
+    where, params = _users_where(name, label, joined_from, joined_to, active_since, has_invite_link)
+    with get_connection() as conn:
+        if after is None:
+            total = conn.execute(SQL_USERS_COUNT.format(where=where), params).fetchone()[0]
+            if not total:
+                return [], 0
+            rows = conn.execute(SQL_USERS_QUERY.format(where=where), params + [limit]).fetchall()
+            return rows, total
+        where += ' AND (join_date, user_id) < (?, ?)'
+        rows = conn.execute(SQL_USERS_QUERY.format(where=where), params + list(after) + [limit]).fetchall()
+    return rows, None
+
+def _users_where(name=None, label=None, joined_from=None, joined_to=None, active_since=None, has_invite_link=None):
+    """WHERE clause and parameters for the query_users filters"""
+    clauses, params = [], []
+    if name:
+        if len(name) >= 3:
+            clauses.append('user_id IN (SELECT rowid FROM users_fts WHERE users_fts MATCH ?)')
+            params.append('"' + name.replace('"', '""') + '"')
+        else:
+            pattern = name.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            clauses.append("(full_name LIKE ? ESCAPE '\\' OR username LIKE ? ESCAPE '\\')")
+            params += [pattern, pattern]
+    if label is not None:
+        clauses.append('label = ?')
+        params.append(label)
+    if joined_from:
+        clauses.append('join_date >= ?')
+        params.append(joined_from)
+    if joined_to:
+        clauses.append('join_date < ?')
+        params.append(joined_to)
+    if active_since:
+        # Same definition as the presence tracker: messages the user sent
+        clauses.append("user_id IN (SELECT user_id FROM messages WHERE timestamp >= ? AND sender = 'user')")
+        params.append(active_since)
+    if has_invite_link is not None:
+        clauses.append("COALESCE(invite_link, '') != ''" if has_invite_link else "COALESCE(invite_link, '') = ''")
+    return ' AND '.join(clauses) or '1', params
+
+def get_new_joins_today():
+    # Range instead of LIKE 'YYYY-MM-DD%' so idx_users_join_date_user_id is used
+    today = datetime.date.today()
+    tomorrow = today + datetime.timedelta(days=1)
+    with get_connection() as conn:
+        return conn.execute(SQL_NEW_JOINS, (today.isoformat(), tomorrow.isoformat())).fetchone()[0]
+
+# --- Messages ---
 def save_message(user_id, sender, message, timestamp=None):
     if timestamp is None:
-        timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('INSERT INTO messages (user_id, sender, message, timestamp) VALUES (?, ?, ?, ?)', (user_id, sender, message, timestamp))
-    conn.commit()
-    conn.close()
+        timestamp = _now()
+    with get_connection() as conn:
+        conn.execute('INSERT INTO messages (user_id, sender, message, timestamp) VALUES (?, ?, ?, ?)',
+                     (user_id, sender, message, timestamp))
+    stats.engine.record_message(user_id, timestamp)
+
+def save_messages_bulk(rows):
+    """Insert many (user_id, sender, message, timestamp) rows in one transaction"""
+    rows = [(user_id, sender, message, timestamp or _now()) for user_id, sender, message, timestamp in rows]
+    if not rows:
+        return
+    with get_connection() as conn:
+        conn.executemany('INSERT INTO messages (user_id, sender, message, timestamp) VALUES (?, ?, ?, ?)', rows)
+    stats.engine.record_messages([(row[0], row[3]) for row in rows])
+
+def get_messages_page(user_id, limit=100, before_id=None, after_id=None):
+    """(id, sender, message, timestamp) rows in chronological order.
+
+    By default the newest `limit` messages; with before_id the `limit`
+    messages just older than it, with after_id the ones just newer.
+    """
+    with get_connection() as conn:
+        if after_id is not None:
+            return conn.execute(SQL_MESSAGES_AFTER, (user_id, after_id, limit)).fetchall()
+        if before_id is None:
+            before_id = MAX_ROWID
+        rows = conn.execute(SQL_MESSAGES_BEFORE, (user_id, before_id, limit)).fetchall()
+    rows.reverse()
+    return rows
 
 def get_messages_for_user(user_id, limit=100):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT sender, message, timestamp FROM messages WHERE user_id = ? ORDER BY id ASC LIMIT ?', (user_id, limit))
-    messages = c.fetchall()
-    conn.close()
-    return messages 
\ No newline at end of file
+    """The newest `limit` (sender, message, timestamp) rows, oldest first"""
+    return [row[1:] for row in get_messages_page(user_id, limit)]
+
+def get_last_activity(user_id):
+    with get_connection() as conn:
+        row = conn.execute(SQL_LAST_ACTIVITY, (user_id,)).fetchone()
+    return row[0] if row else None
+
+def get_total_messages():
+    with get_connection() as conn:
+        return conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+
+def get_active_users(minutes=60):
+    since = (datetime.datetime.now() - datetime.timedelta(minutes=minutes)).strftime('%Y-%m-%d %H:%M:%S')
+    with get_connection() as conn:
+        return conn.execute(SQL_ACTIVE_USERS, (since,)).fetchone()[0]
+
+# --- Media ---
+SQL_SAVE_MEDIA = '''INSERT INTO media (file_unique_id, file_id, media_type, file_size, mime_type, file_name, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(file_unique_id) DO UPDATE SET file_id = excluded.file_id'''
+
+def save_media(file_unique_id, file_id, media_type, file_size=None, mime_type=None, file_name=None):
+    with get_connection() as conn:
+        conn.execute(SQL_SAVE_MEDIA, (file_unique_id, file_id, media_type, file_size, mime_type, file_name, _now()))
+
+def save_media_messages(media_rows, message_rows):
+    """Insert save_media rows and the (user_id, sender, message, timestamp) rows that reference them in one transaction"""
+    now = _now()
+    message_rows = [(user_id, sender, message, timestamp or now) for user_id, sender, message, timestamp in message_rows]
+    with get_connection() as conn:
+        conn.executemany(SQL_SAVE_MEDIA, [tuple(row) + (now,) for row in media_rows])
+        conn.executemany('INSERT INTO messages (user_id, sender, message, timestamp) VALUES (?, ?, ?, ?)', message_rows)
+    stats.engine.record_messages([(row[0], row[3]) for row in message_rows])
+
+def get_media(file_unique_id):
+    """Returns (file_unique_id, file_id, media_type, file_size, mime_type, file_name) or None"""
+    with get_connection() as conn:
+        return conn.execute('SELECT file_unique_id, file_id, media_type, file_size, mime_type, file_name FROM media WHERE file_unique_id = ?',
+                            (file_unique_id,)).fetchone()
+
+# --- Search ---
+SEARCH_BACKFILL_CHUNK = 5000
+SEARCH_CANDIDATES = 2000  # results are ranked among this many most recent matches
+SNIPPET_START, SNIPPET_END = '\x02', '\x03'  # mark matches; the caller escapes and swaps them
+SQL_SEARCH = f'''SELECT m.id, m.user_id, u.full_name, m.sender,
+                        snippet(messages_fts, 0, '{SNIPPET_START}', '{SNIPPET_END}', '…', 16), m.timestamp
+                 FROM messages_fts
+                 JOIN messages m ON m.id = messages_fts.rowid
+                 LEFT JOIN users u ON u.user_id = m.user_id
+                 WHERE messages_fts MATCH :query {{recent_only}}
+                 ORDER BY rank LIMIT :limit'''
+# Across all users, rank only the most recent matches so common words stay cheap
+SQL_SEARCH_RECENT = f'''AND messages_fts.rowid >= (SELECT MIN(rowid) FROM (
+                            SELECT rowid FROM messages_fts WHERE messages_fts MATCH :query
+                            ORDER BY rowid DESC LIMIT {SEARCH_CANDIDATES}))'''
+
+def fts_query(text, user_id=None):
+    """FTS5 MATCH expression for free text: every word as a quoted prefix term in the message column"""
+    terms = ' '.join(f'"{word}"*' for word in re.findall(r'\w+', text or ''))
+    if not terms:
+        return ''
+    if user_id is not None:
+        # user_id is indexed too, so FTS5 intersects with that user's rows itself
+        return f'user_id : "{int(user_id)}" AND message : ({terms})'
+    return f'message : ({terms})'
+
+def search_messages(text, user_id=None, limit=20):
+    """Best matches first: (id, user_id, full_name, sender, snippet, timestamp) rows.
+
+    Across all users, ranking (bm25) covers the SEARCH_CANDIDATES most
+    recent matches, so a very common word stays cheap; within one user's
+    history every match is ranked.
+    """
+    query = fts_query(text, user_id)
+    if not query:
+        return []
+    sql = SQL_SEARCH.format(recent_only=SQL_SEARCH_RECENT if user_id is None else '')
+    with get_connection() as conn:
+        return conn.execute(sql, {'query': query, 'limit': limit}).fetchall()
+
+def backfill_search_index(chunk_size=SEARCH_BACKFILL_CHUNK):
+    """Index messages older than migration 5, one short transaction per chunk; returns rows indexed.
+
+    New rows are indexed by triggers, so this only walks the pre-existing
+    id range recorded in search_backfill. Safe to interrupt and rerun.
+    """
+    indexed = 0
+    while True:
+        with get_connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT next_id, end_id FROM search_backfill').fetchone()
+            if row is None:
+                return indexed
+            next_id, end_id = row
+            if next_id > end_id:
+                conn.execute('DELETE FROM search_backfill')
+                print(f"Search index backfill done ({indexed} messages this run)")
+                return indexed
+            upper = min(next_id + chunk_size - 1, end_id)
+            indexed += conn.execute(
+                f'''INSERT INTO messages_fts (rowid, message, user_id) SELECT id, message, user_id FROM messages
+                    WHERE id BETWEEN ? AND ? AND {_FTS_INDEXED.format(row='messages')}''',
+                (next_id, upper)).rowcount
+            conn.execute('UPDATE search_backfill SET next_id = ?', (upper + 1,))
+
+# --- Broadcast jobs ---
+def create_broadcast_job(job_id, message, user_ids, created_at=None):
+    with get_connection() as conn:
+        conn.execute('INSERT INTO broadcast_jobs (job_id, message, status, created_at) VALUES (?, ?, ?, ?)',
+                     (job_id, message, 'queued', created_at or _now()))
+        conn.executemany('INSERT OR IGNORE INTO broadcast_recipients (job_id, user_id) VALUES (?, ?)',
+                         ((job_id, user_id) for user_id in user_ids))
+
+def get_broadcast_job(job_id):
+    """Returns (job_id, message, status, created_at, finished_at) or None"""
+    with get_connection() as conn:
+        return conn.execute('SELECT job_id, message, status, created_at, finished_at FROM broadcast_jobs WHERE job_id = ?',
+                            (job_id,)).fetchone()
+
+def get_unfinished_broadcast_jobs():
+    """Jobs resume() should run: queued, interrupted ('running') or stopped by an error"""
+    with get_connection() as conn:
+        return conn.execute("SELECT job_id, message, status, created_at, finished_at FROM broadcast_jobs WHERE status IN ('queued', 'running', 'error') ORDER BY created_at").fetchall()
+
+def set_broadcast_job_status(job_id, status, finished=False):
+    with get_connection() as conn:
+        conn.execute('UPDATE broadcast_jobs SET status = ?, finished_at = ? WHERE job_id = ?',
+                     (status, _now() if finished else None, job_id))
+
+def get_broadcast_counts(job_id):
+    """Recipient counts per state, e.g. {'pending': 10, 'sent': 90}"""
+    with get_connection() as conn:
+        rows = conn.execute('SELECT state, COUNT(*) FROM broadcast_recipients WHERE job_id = ? GROUP BY state', (job_id,)).fetchall()
+    return dict(rows)
+
+def get_pending_recipients(job_id, limit):
+    with get_connection() as conn:
+        return [row[0] for row in conn.execute("SELECT user_id FROM broadcast_recipients WHERE job_id = ? AND state = 'pending' LIMIT ?",
+                                               (job_id, limit))]
+
+def record_broadcast_results(job_id, results, message_rows):
+    """Checkpoint a batch: recipient states and the outgoing message rows in one transaction.
+
+    results are (user_id, state, error); message_rows are (user_id, sender, message, timestamp).
+    """
+    message_rows = [(user_id, sender, message, timestamp or _now()) for user_id, sender, message, timestamp in message_rows]
+    with get_connection() as conn:
+        conn.executemany('UPDATE broadcast_recipients SET state = ?, error = ? WHERE job_id = ? AND user_id = ?',
+                         ((state, error, job_id, user_id) for user_id, state, error in results))
+        conn.executemany('INSERT INTO messages (user_id, sender, message, timestamp) VALUES (?, ?, ?, ?)', message_rows)
+    stats.engine.record_messages([(row[0], row[3]) for row in message_rows])
+
+# --- Runtime metrics ---
+def save_runtime_metrics(name, value):
+    with get_connection() as conn:
+        conn.execute('INSERT OR REPLACE INTO runtime_metrics (name, value, updated_at) VALUES (?, ?, ?)', (name, value, _now()))
+
+def get_runtime_metrics(name):
+    """Returns (value, updated_at) or None"""
+    with get_connection() as conn:
+        return conn.execute('SELECT value, updated_at FROM runtime_metrics WHERE name = ?', (name,)).fetchone()
+
+# --- Query plan checks ---
+def _users_query(count=False, **filters):
+    """A query_users first-page query (rows or total) for the plan checks"""
+    where, params = _users_where(**filters)
+    if count:
+        return SQL_USERS_COUNT.format(where=where), params
+    return SQL_USERS_QUERY.format(where=where), params + [50]
+
+DASHBOARD_QUERIES = {
+    'users_page': (SQL_USERS_PAGE, (10, 0)),
+    'users_after': (SQL_USERS_AFTER, ('2024-01-01 00:00:00', 1, 10)),
+    'users_label_after': (SQL_USERS_QUERY.format(where='label = ? AND (join_date, user_id) < (?, ?)'),
+                          ('vip', '2024-01-01 00:00:00', 1, 50)),
+    'new_joins_today': (SQL_NEW_JOINS, ('2024-01-01', '2024-01-02')),
+    'chat_history': (SQL_MESSAGES_BEFORE, (1, MAX_ROWID, 100)),
+    'chat_history_after': (SQL_MESSAGES_AFTER, (1, 0, 100)),
+    'last_activity': (SQL_LAST_ACTIVITY, (1,)),
+    'active_users': (SQL_ACTIVE_USERS, ('2024-01-01 00:00:00',)),
+    # /users filters and /search, built as query_users and search_messages build them
+    'users_name': _users_query(name='user12'),
+    'users_name_count': _users_query(count=True, name='user12'),
+    'users_active_since': _users_query(active_since='2024-01-01 00:00:00'),
+    'users_active_since_count': _users_query(count=True, active_since='2024-01-01 00:00:00'),
+    'search': (SQL_SEARCH.format(recent_only=SQL_SEARCH_RECENT), {'query': fts_query('message'), 'limit': 20}),
+    'search_user': (SQL_SEARCH.format(recent_only=''), {'query': fts_query('message', 1), 'limit': 20}),
+}
+
+def check_query_plans():
+    """EXPLAIN QUERY PLAN every dashboard query.
+
+    Returns {name: (uses_index, plan_lines)}; a query fails the check if any
+    step is a plain table SCAN or needs a temp B-tree for ORDER BY.
+    """
+    results = {}
+    with get_connection() as conn:
+        for name, (sql, params) in DASHBOARD_QUERIES.items():
+            plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+            bad = [line for line in plan
+                   if (line.startswith('SCAN') and 'INDEX' not in line) or 'TEMP B-TREE FOR ORDER BY' in line]
+            results[name] = (not bad, plan)
+    return results
@@ -0,0 +1,160 @@
+import datetime
+import threading
+
+EMIT_WINDOW = 0.25         # seconds events are coalesced before being emitted
+ADMIN_ROOM = 'admin'       # every dashboard connection joins it for summaries
+MAX_ROOM_MESSAGES = 50     # per chat room per window; beyond that clients refetch
+MAX_SUMMARY_USERS = 200    # per-user entries in one dashboard_update
+
+class EventBus:
+    """Coalesces dashboard Socket.IO events.
+
+    The app publishes messages as they are saved; a flusher thread emits at
+    most once per room per window:
+
+    - 'new_message' to chat_<user_id>, with the new messages as a delta
+      ({'user_id', 'messages': [{'sender', 'message', 'timestamp'}],
+      'truncated'}), plus 'admin_message_sent' when the batch has admin
+      messages. Only rooms someone has joined are emitted to.
+    - 'dashboard_update' to ADMIN_ROOM: per-user message counts and last
+      message for the window, so the user list updates without refetching,
+      and 'presence' ({user_id: online}) for users who came online or
+      went offline.
+
+    render(text) turns a stored message into what clients see (media refs
+    into URLs). With track_rooms=False (Socket.IO behind a message queue,
+    where clients join rooms on other processes) membership is unknown:
+    rooms with messages from messages() are emitted to regardless, while
+    broadcast() rows only reach the admin summary, since emitting to every
+    recipient's room would be two events per recipient again.
+    """
+
+    def __init__(self, socketio, window=EMIT_WINDOW, render=None, track_rooms=True):
+        self.socketio = socketio
+        self.window = window
+        self.render = render or (lambda text: text)
+        self.track_rooms = track_rooms
+        self._rooms = {}       # user_id -> [message dicts]
+        self._summary = {}     # user_id -> {'count', 'last', 'full_name', 'username'}
+        self._total = 0
+        self._presence = {}    # user_id -> online, latest transition wins
+        self._members = {}     # room -> number of sids in it
+        self._sid_rooms = {}   # sid -> set of rooms
+        self._cond = threading.Condition()
+        self._thread = None
+        self.published = 0
+        self.emitted = 0
+
+    # --- Subscriptions ---
+    def join(self, sid, room):
+        with self._cond:
+            rooms = self._sid_rooms.setdefault(sid, set())
+            if room not in rooms:
+                rooms.add(room)
+                self._members[room] = self._members.get(room, 0) + 1
+
+    def disconnect(self, sid):
+        with self._cond:
+            for room in self._sid_rooms.pop(sid, ()):
+                count = self._members.get(room, 0) - 1
+                if count > 0:
+                    self._members[room] = count
+                else:
+                    self._members.pop(room, None)
+
+    # --- Publishing ---
+    def message(self, user_id, sender, message, timestamp=None, full_name=None, username=None):
+        self.messages([(user_id, sender, message, timestamp)], full_name, username)
+
+    def messages(self, rows, full_name=None, username=None, to_rooms=True):
+        """Publish saved (user_id, sender, message, timestamp) rows"""
+        now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self._cond:
+            for user_id, sender, message, timestamp in rows:
+                item = {'sender': sender, 'message': message, 'timestamp': timestamp or now}
+                if to_rooms:
+                    self._rooms.setdefault(user_id, []).append(item)
+                entry = self._summary.get(user_id)
+                if entry is None:
+                    entry = self._summary[user_id] = {'count': 0}
+                entry['count'] += 1
+                entry['last'] = item
+                if full_name is not None:
+                    entry['full_name'] = full_name
+                    entry['username'] = username
+                self._total += 1
+            self.published += len(rows)
+            self._cond.notify_all()
+        if self._thread is None:
+            self.start()
+
+    def broadcast(self, rows):
+        """Publish rows saved by a broadcast (BroadcastEngine on_batch)"""
+        self.messages(rows, to_rooms=self.track_rooms)
+
+    def presence(self, user_id, online):
+        """Publish an online/offline transition"""
+        with self._cond:
+            self._presence[user_id] = online
+            self.published += 1
+            self._cond.notify_all()
+        if self._thread is None:
+            self.start()
+
+    # --- Flushing ---
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='event-bus', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._rooms and not self._summary and not self._presence:
+                    self._cond.wait()
+            # Let the window fill before emitting
+            threading.Event().wait(self.window)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Event bus flush failed: {e}")
+
+    def flush(self):
+        with self._cond:
+            rooms, self._rooms = self._rooms, {}
+            summary, self._summary = self._summary, {}
+            total, self._total = self._total, 0
+            presence, self._presence = self._presence, {}
+            members = dict(self._members)
+        for user_id, items in rooms.items():
+            room = f'chat_{user_id}'
+            if self.track_rooms and room not in members:
+                continue
+            truncated = len(items) > MAX_ROOM_MESSAGES
+            items = items[-MAX_ROOM_MESSAGES:]
+            for item in items:
+                item['message'] = self.render(item['message'])
+            self.socketio.emit('new_message', {'user_id': user_id, 'messages': items, 'truncated': truncated}, room=room)
+            self.emitted += 1
+            if any(item['sender'] == 'admin' for item in items):
+                self.socketio.emit('admin_message_sent', {'user_id': user_id}, room=room)
+                self.emitted += 1
+        if (summary or presence) and (ADMIN_ROOM in members or not self.track_rooms):
+            users = {}
+            for user_id, entry in list(summary.items())[-MAX_SUMMARY_USERS:]:
+                entry['last'] = dict(entry['last'], message=self.render(entry['last']['message']))
+                users[user_id] = entry
+            self.socketio.emit('dashboard_update', {
+                'users': users,
+                'user_count': len(summary),
+                'message_count': total,
+                'truncated': len(summary) > MAX_SUMMARY_USERS,
+                'presence': presence,
+            }, room=ADMIN_ROOM)
+            self.emitted += 1
+
+    def metrics(self):
+        with self._cond:
+            return {'published': self.published, 'emitted': self.emitted, 'rooms': len(self._members)}
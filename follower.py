@@ -0,0 +1,77 @@
+import datetime
+import threading
+import time
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+POLL_INTERVAL = 2     # seconds between reads of new message rows
+USERS_RESYNC = 30     # seconds between reloads of the user counters
+BATCH_SIZE = 5000
+
+SQL_NEW_MESSAGES = 'SELECT id, user_id, sender, timestamp FROM messages WHERE id > ? ORDER BY id LIMIT ?'
+
+class DatabaseFollower:
+    """Keeps a web worker's stats and presence in step with other processes' writes.
+
+    With the bots running in bot_runner.py, a gunicorn worker never sees the
+    save_message()/add_user() calls for incoming traffic, so its
+    stats.engine counters and presence tracker would freeze at startup. A
+    thread reads messages rows past the last id it saw (a range on the
+    primary key, so the cost is the number of new rows) into both, and
+    reloads the user counters every USERS_RESYNC seconds. Rows this worker
+    writes itself arrive the same way, so nothing is counted twice.
+    """
+
+    def __init__(self, stats_engine, presence, interval=POLL_INTERVAL, users_resync=USERS_RESYNC):
+        self.stats = stats_engine
+        self.presence = presence
+        self.interval = interval
+        self.users_resync = users_resync
+        self.last_id = 0
+        self.followed_rows = 0
+        self._thread = None
+
+    def start(self, get_connection):
+        """Warm up from one consistent snapshot, then follow from its last message id"""
+        if self._thread is not None:
+            return
+        self.stats.followed = True
+        with get_connection() as conn:
+            conn.execute('BEGIN')
+            self.last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0]
+            self.stats.warm_up(conn)
+            self.presence.warm_up(conn)
+        self._get_connection = get_connection
+        self._thread = threading.Thread(target=self._run, name='db-follower', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        users_synced = time.monotonic()
+        while True:
+            time.sleep(self.interval)
+            try:
+                with self._get_connection() as conn:
+                    self.poll(conn)
+                    if time.monotonic() - users_synced >= self.users_resync:
+                        self.stats.resync_users(conn)
+                        users_synced = time.monotonic()
+            except Exception as e:
+                print(f"Database follower failed: {e}")
+
+    def poll(self, conn):
+        """Apply message rows written since the last poll; returns how many"""
+        count = 0
+        while True:
+            rows = conn.execute(SQL_NEW_MESSAGES, (self.last_id, BATCH_SIZE)).fetchall()
+            if not rows:
+                break
+            self.stats.add_messages([(user_id, timestamp) for _, user_id, _, timestamp in rows])
+            for _, user_id, sender, timestamp in rows:
+                if sender == 'user' and timestamp:
+                    seen_at = datetime.datetime.strptime(timestamp, TIME_FORMAT).timestamp()
+                    self.presence.seen(user_id, seen_at, notify=False)
+            self.last_id = rows[-1][0]
+            count += len(rows)
+            if len(rows) < BATCH_SIZE:
+                break
+        self.followed_rows += count
+        return count
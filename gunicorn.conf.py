@@ -0,0 +1,24 @@
+# gunicorn settings for the dashboard API:
+#
+#   gunicorn -c gunicorn.conf.py api:app
+#
+# The Telegram bots do not run in these workers; start bot_runner.py next to
+# them. With more than one worker, set SOCKETIO_MESSAGE_QUEUE so rooms are
+# shared. Socket.IO long-polling also needs every request of a session to
+# reach the same worker, so either run several single-worker instances
+# behind a proxy with sticky sessions (nginx ip_hash, see nginx.conf and
+# docker-compose.yml) or connect the dashboard with the websocket transport
+# only.
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+worker_class = 'gevent'
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+timeout = 120
+
+
+def post_worker_init(worker):
+    # Counters and presence follow what the bot process writes
+    import api
+    api.follow_database()
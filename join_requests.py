@@ -0,0 +1,379 @@
+import asyncio
+import datetime
+import html
+import json
+import threading
+import time
+from collections import OrderedDict, deque
+
+from db import add_user, add_users_bulk, save_runtime_metrics
+from ratelimit import TokenBucket, flood_wait_seconds
+
+BACKEND_BOTAPI = 'botapi'    # python-telegram-bot ChatJoinRequestHandler
+BACKEND_MTPROTO = 'mtproto'  # Pyrogram on_chat_join_request
+BACKENDS = (BACKEND_BOTAPI, BACKEND_MTPROTO)
+
+DEFAULT_WELCOME_TEXT = "🎉 Hi {mention}, you are now a member of {title}!"
+SEEN_CAPACITY = 50000
+
+# Join approval scheduler tuning
+API_RATE = 20               # approve + DM calls per second, shared
+APPROVAL_CONCURRENCY = 8
+DM_CONCURRENCY = 2
+LATENCY_SAMPLES = 2000
+CATCH_UP_BATCH = 100        # pending requests approved and stored per batch
+METRICS_INTERVAL = 5        # seconds between metrics snapshots stored for the web workers
+METRICS_NAME = 'join_queue'
+
+def catch_up_client(api_id, api_hash, session_string):
+    """Pyrogram user client for JoinRequestPipeline.catch_up() listings.
+
+    MTProto only lets user accounts list pending join requests, so this
+    logs in with the session string of a chat admin's account; None when
+    no session is configured. Not started here; use it as `async with`.
+    """
+    if not session_string:
+        return None
+    from pyrogram import Client
+    return Client('JoinRequestCatchUp', api_id=api_id, api_hash=api_hash,
+                  session_string=session_string, in_memory=True, no_updates=True)
+
+def normalize_chat_id(chat_id):
+    """config.CHAT_ID is a string like '-100123...'; Telegram ids are ints"""
+    if isinstance(chat_id, str) and chat_id.lstrip('-').isdigit():
+        return int(chat_id)
+    return chat_id
+
+class JoinTask:
+    __slots__ = ('chat_id', 'chat_title', 'user', 'invite_link', 'approve', 'send_dm', 'mention', 'enqueued_at')
+
+    def __init__(self, chat_id, chat_title, user, invite_link, approve, send_dm, mention):
+        self.chat_id = chat_id
+        self.chat_title = chat_title
+        self.user = user
+        self.invite_link = invite_link
+        self.approve = approve
+        self.send_dm = send_dm
+        self.mention = mention
+        self.enqueued_at = time.monotonic()
+
+class JoinApprovalScheduler:
+    """Absorbs join-request bursts and approves them under a flood-aware rate limit.
+
+    Handlers only enqueue. Approval workers (bounded by APPROVAL_CONCURRENCY)
+    drain the approval lane first; welcome DMs go to a separate lane whose
+    workers only run while no approvals are waiting, so DMs can never starve
+    approvals. A FloodWait/RetryAfter pauses the shared bucket and puts the
+    task back at the head of its lane. Workers start on the first submit,
+    on the loop the handlers run on.
+    """
+
+    def __init__(self, welcome_text, rate=API_RATE, approval_concurrency=APPROVAL_CONCURRENCY,
+                 dm_concurrency=DM_CONCURRENCY):
+        self.welcome_text = welcome_text
+        self.rate = rate
+        self.approval_concurrency = approval_concurrency
+        self.dm_concurrency = dm_concurrency
+        self._approvals = deque()
+        self._dms = deque()
+        self._bucket = None
+        self._approval_ready = None
+        self._dm_ready = None
+        self._approvals_idle = None
+        self._workers = []
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.counters = {'approved': 0, 'already_participant': 0, 'approve_failed': 0,
+                         'dm_sent': 0, 'dm_failed': 0, 'flood_waits': 0}
+        self._in_flight = 0
+
+    def submit(self, task):
+        self._ensure_workers()
+        self._approvals.append(task)
+        self._approvals_idle.clear()
+        self._approval_ready.set()
+
+    def _ensure_workers(self):
+        if self._workers:
+            return
+        self._bucket = TokenBucket(self.rate)
+        self._approval_ready = asyncio.Event()
+        self._dm_ready = asyncio.Event()
+        self._approvals_idle = asyncio.Event()
+        self._approvals_idle.set()
+        self._workers = [asyncio.ensure_future(self._approval_worker()) for _ in range(self.approval_concurrency)]
+        self._workers += [asyncio.ensure_future(self._dm_worker()) for _ in range(self.dm_concurrency)]
+
+    def queue_dm(self, task):
+        """Send a welcome DM on the low-priority lane for an already approved request"""
+        self._ensure_workers()
+        self._dms.append(task)
+        self._dm_ready.set()
+
+    async def approve_now(self, approve):
+        """Run one approve call under the shared limit, waiting out flood errors"""
+        self._ensure_workers()
+        while True:
+            await self._bucket.acquire()
+            try:
+                return await approve()
+            except Exception as e:
+                wait = flood_wait_seconds(e)
+                if wait is None:
+                    raise
+                self.counters['flood_waits'] += 1
+                self._bucket.pause(wait)
+
+    async def _approval_worker(self):
+        while True:
+            if not self._approvals:
+                if self._in_flight == 0:
+                    self._approvals_idle.set()
+                self._approval_ready.clear()
+                await self._approval_ready.wait()
+                continue
+            task = self._approvals.popleft()
+            self._in_flight += 1
+            try:
+                await self._approve(task)
+            finally:
+                self._in_flight -= 1
+
+    async def _approve(self, task):
+        user = task.user
+        await self._bucket.acquire()
+        try:
+            await task.approve()
+        except Exception as e:
+            wait = flood_wait_seconds(e)
+            if wait is not None:
+                self.counters['flood_waits'] += 1
+                print(f"Flood wait {wait}s while approving {user.id}, pausing approvals")
+                self._bucket.pause(wait)
+                self._approvals.appendleft(task)
+            elif "USER_ALREADY_PARTICIPANT" in str(e).upper():
+                self.counters['already_participant'] += 1
+                print(f"User {user.first_name} ({user.id}) is already a participant in {task.chat_title}")
+            else:
+                self.counters['approve_failed'] += 1
+                print(f"Error approving join request for {user.first_name} ({user.id}): {e}")
+            return
+        self.counters['approved'] += 1
+        self._latencies.append(time.monotonic() - task.enqueued_at)
+
+        full_name = f"{user.first_name or ''} {user.last_name or ''}".strip()
+        username = user.username or ''
+        join_date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        # Off the bot loop: the commit would stall PTB, Pyrogram and the other workers
+        await asyncio.to_thread(add_user, user.id, full_name, username, join_date, task.invite_link)
+
+        self._dms.append(task)
+        self._dm_ready.set()
+
+    async def _dm_worker(self):
+        while True:
+            if not self._dms:
+                self._dm_ready.clear()
+                await self._dm_ready.wait()
+                continue
+            # Lower priority lane: only spend rate-limit tokens when no approval is waiting
+            await self._approvals_idle.wait()
+            if not self._dms:
+                continue
+            task = self._dms.popleft()
+            await self._send_dm(task)
+
+    async def _send_dm(self, task):
+        user = task.user
+        await self._bucket.acquire()
+        try:
+            await task.send_dm(self.welcome_text.format(mention=task.mention, title=html.escape(task.chat_title or '')))
+            self.counters['dm_sent'] += 1
+        except Exception as e:
+            wait = flood_wait_seconds(e)
+            if wait is not None:
+                self.counters['flood_waits'] += 1
+                self._bucket.pause(wait)
+                self._dms.appendleft(task)
+            else:
+                self.counters['dm_failed'] += 1
+                print(f"Failed to send DM to {user.first_name} ({user.id}): {e}")
+
+    def metrics(self):
+        now = time.monotonic()
+        approvals = list(self._approvals)
+        latencies = sorted(self._latencies)
+        return {
+            'approval_queue_depth': len(approvals),
+            'dm_queue_depth': len(self._dms),
+            'approvals_in_flight': self._in_flight,
+            'backlog_age_seconds': round(now - approvals[0].enqueued_at, 3) if approvals else 0.0,
+            'approval_latency_p50': round(_percentile(latencies, 0.50), 3),
+            'approval_latency_p99': round(_percentile(latencies, 0.99), 3),
+            **self.counters,
+        }
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+class JoinRequestPipeline:
+    """Single handler for channel join requests.
+
+    Exactly one backend is registered, and every request is keyed on
+    (chat_id, user_id, date) so a redelivered update is not approved,
+    stored or welcomed twice. Each request costs one approve call, one
+    add_user write and one welcome DM, run by the JoinApprovalScheduler.
+    """
+
+    def __init__(self, backend, chat_id=None, welcome_text=None):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown join request backend {backend!r}; expected one of {BACKENDS}")
+        self.backend = backend
+        self.chat_id = normalize_chat_id(chat_id)
+        self.welcome_text = welcome_text or DEFAULT_WELCOME_TEXT
+        self.scheduler = JoinApprovalScheduler(self.welcome_text)
+        self.catch_up_progress = None
+        self._seen = OrderedDict()
+        self._seen_lock = threading.Lock()
+
+    def snapshot(self):
+        """Scheduler metrics and catch-up progress, as served by /join-queue-stats"""
+        return {**self.scheduler.metrics(), 'catch_up': self.catch_up_progress}
+
+    async def publish(self, interval=METRICS_INTERVAL):
+        """Store snapshot() every interval so web workers without the bots can serve it"""
+        while True:
+            try:
+                await asyncio.to_thread(save_runtime_metrics, METRICS_NAME, json.dumps(self.snapshot()))
+            except Exception as e:
+                print(f"Join metrics publish failed: {e}")
+            await asyncio.sleep(interval)
+
+    def register(self, application, pyro_client):
+        """Attach the pipeline to the configured backend only"""
+        if self.backend == BACKEND_BOTAPI:
+            from telegram.ext import ChatJoinRequestHandler
+            application.add_handler(ChatJoinRequestHandler(self.handle_botapi, chat_id=self.chat_id))
+        else:
+            from pyrogram import filters
+            from pyrogram.handlers import ChatJoinRequestHandler
+            chat_filter = filters.chat(self.chat_id) if self.chat_id is not None else None
+            pyro_client.add_handler(ChatJoinRequestHandler(self.handle_mtproto, chat_filter))
+
+    def claim(self, chat_id, user_id, date):
+        """True the first time a request is seen, False for duplicates"""
+        key = (chat_id, user_id, date)
+        with self._seen_lock:
+            if key in self._seen:
+                return False
+            self._seen[key] = True
+            if len(self._seen) > SEEN_CAPACITY:
+                self._seen.popitem(last=False)
+            return True
+
+    # --- Backend adapters ---
+    async def handle_botapi(self, update, context):
+        join_request = update.chat_join_request
+        user = join_request.from_user
+        chat = join_request.chat
+        invite_link = join_request.invite_link.invite_link if join_request.invite_link else None
+        await self.process(
+            chat.id, chat.title, user, join_request.date, invite_link,
+            approve=join_request.approve,
+            send_dm=lambda text: context.bot.send_message(user.id, text, parse_mode='HTML'),
+            mention=user.mention_html(),
+        )
+
+    async def handle_mtproto(self, client, join_request):
+        user = join_request.from_user
+        chat = join_request.chat
+        link = getattr(join_request, 'invite_link', None)
+        await self.process(
+            chat.id, chat.title, user, join_request.date, link.invite_link if link else None,
+            approve=lambda: client.approve_chat_join_request(chat.id, user.id),
+            send_dm=lambda text: client.send_message(user.id, text),
+            mention=user.mention,
+        )
+
+    # --- Pipeline ---
+    async def process(self, chat_id, chat_title, user, date, invite_link, approve, send_dm, mention):
+        if not self.claim(chat_id, user.id, date):
+            print(f"Duplicate join request for {user.id} in {chat_id}, skipping")
+            return
+        self.scheduler.submit(JoinTask(chat_id, chat_title, user, invite_link, approve, send_dm, mention))
+
+    # --- Startup catch-up ---
+    async def catch_up(self, client, lister, batch_size=CATCH_UP_BATCH):
+        """Approve join requests that piled up while the bot was offline.
+
+        Pages through lister.get_chat_join_requests(), approves each batch
+        concurrently under the scheduler's rate limit with the bot `client`,
+        stores the batch with one add_users_bulk() and queues welcome DMs on
+        the low-priority lane. Listing is a user-account call (neither the
+        Bot API nor a bot MTProto session may use it), so lister is a
+        started catch_up_client(). Progress is kept in catch_up_progress.
+        Only needs get_chat, approve_chat_join_request and send_message on
+        the client and get_chat_join_requests on the lister.
+        """
+        if self.chat_id is None:
+            return None
+        progress = self.catch_up_progress = {
+            'status': 'running', 'seen': 0, 'approved': 0, 'stored': 0,
+            'skipped': 0, 'failed': 0, 'batches': 0,
+        }
+        try:
+            chat = await client.get_chat(self.chat_id)
+            batch = []
+            async for joiner in lister.get_chat_join_requests(self.chat_id):
+                progress['seen'] += 1
+                # A live update for the same request may already be queued
+                if not self.claim(self.chat_id, joiner.user.id, joiner.date):
+                    progress['skipped'] += 1
+                    continue
+                batch.append(joiner)
+                if len(batch) >= batch_size:
+                    await self._catch_up_batch(client, chat, batch, progress)
+                    batch = []
+            if batch:
+                await self._catch_up_batch(client, chat, batch, progress)
+            progress['status'] = 'done'
+        except Exception as e:
+            progress['status'] = 'error'
+            progress['error'] = str(e)
+            print(f"Join request catch-up stopped: {e}")
+        print(f"Join request catch-up {progress['status']}: {progress}")
+        return progress
+
+    async def _catch_up_batch(self, client, chat, joiners, progress):
+        semaphore = asyncio.Semaphore(self.scheduler.approval_concurrency)
+
+        async def approve(joiner):
+            async with semaphore:
+                try:
+                    await self.scheduler.approve_now(
+                        lambda: client.approve_chat_join_request(chat.id, joiner.user.id))
+                    return True
+                except Exception as e:
+                    if "USER_ALREADY_PARTICIPANT" not in str(e).upper():
+                        print(f"Catch-up approval failed for {joiner.user.id}: {e}")
+                    return False
+
+        results = await asyncio.gather(*(approve(joiner) for joiner in joiners))
+        approved = [joiner for joiner, ok in zip(joiners, results) if ok]
+        join_date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        rows = [(j.user.id, f"{j.user.first_name or ''} {j.user.last_name or ''}".strip(), j.user.username or '', join_date, None)
+                for j in approved]
+        progress['stored'] += await asyncio.to_thread(add_users_bulk, rows)
+        for joiner in approved:
+            user = joiner.user
+            self.scheduler.queue_dm(JoinTask(
+                chat.id, chat.title, user, None, None,
+                lambda text, user_id=user.id: client.send_message(user_id, text),
+                user.mention,
+            ))
+        progress['approved'] += len(approved)
+        progress['failed'] += len(joiners) - len(approved)
+        progress['batches'] += 1
+        print(f"Join request catch-up: {progress['approved']} approved, {progress['failed']} failed, {progress['seen']} seen")
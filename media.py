@@ -0,0 +1,108 @@
+import re
+import threading
+import time
+
+import httpx
+
+from db import save_media, get_media
+
+# Message rows reference media as "[image]media:<file_unique_id>" instead of
+# a bot-token file URL; the dashboard gets a resolver URL in its place.
+REF_PREFIX = 'media:'
+FILE_PATH_TTL = 50 * 60  # Telegram file paths stay valid for at least an hour
+
+_REF_RE = re.compile(r'^(\[[a-z]+\])?' + re.escape(REF_PREFIX) + r'([A-Za-z0-9_\-]+)$')
+
+def media_row(attachment, media_type, file_name=None):
+    """db.save_media arguments for a PTB attachment (PhotoSize, Video, Voice, Audio, ...)"""
+    return (
+        attachment.file_unique_id,
+        attachment.file_id,
+        media_type,
+        getattr(attachment, 'file_size', None),
+        getattr(attachment, 'mime_type', None),
+        file_name or getattr(attachment, 'file_name', None),
+    )
+
+def register(attachment, media_type, file_name=None):
+    """Store a PTB attachment and return its reference"""
+    save_media(*media_row(attachment, media_type, file_name))
+    return REF_PREFIX + attachment.file_unique_id
+
+def attachment_of(message):
+    """(attachment, media_type) for a message carrying a photo, video or audio; (None, None) otherwise"""
+    if message.photo:
+        return message.photo[-1], 'image'
+    if message.video:
+        return message.video, 'video'
+    if message.audio:
+        return message.audio, 'audio'
+    return None, None
+
+def parse_ref(text):
+    """'[image]media:AQAD' -> 'AQAD'; None for anything else"""
+    match = _REF_RE.match(text or '')
+    return match.group(2) if match else None
+
+def to_public(text, url_for_media):
+    """Swap a media reference for url_for_media(file_unique_id), keeping the [type] prefix"""
+    match = _REF_RE.match(text or '')
+    if not match:
+        return text
+    return (match.group(1) or '') + url_for_media(match.group(2))
+
+class FilePathCache:
+    """Short-TTL cache of file_unique_id -> Telegram file_path"""
+
+    def __init__(self, ttl=FILE_PATH_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, file_unique_id):
+        with self._lock:
+            entry = self._entries.get(file_unique_id)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self._entries[file_unique_id]
+                return None
+            return entry[0]
+
+    def put(self, file_unique_id, file_path):
+        with self._lock:
+            self._entries[file_unique_id] = (file_path, time.monotonic() + self.ttl)
+            if len(self._entries) > 10000:
+                now = time.monotonic()
+                self._entries = {k: v for k, v in self._entries.items() if v[1] >= now}
+
+file_paths = FilePathCache()
+
+async def resolve_file_path(bot, file_unique_id):
+    """file_path for a stored media item via get_file, cached; None if unknown"""
+    file_path = file_paths.get(file_unique_id)
+    if file_path is not None:
+        return file_path
+    row = get_media(file_unique_id)
+    if row is None:
+        return None
+    file = await bot.get_file(row[1])
+    file_paths.put(file_unique_id, file.file_path)
+    return file.file_path
+
+def file_url(token, file_path):
+    if file_path.startswith('http'):
+        return file_path
+    return f"https://api.telegram.org/file/bot{token}/{file_path}"
+
+_client = None
+
+def http_client():
+    """Shared HTTPX client for Telegram file downloads; use on the bot event loop only"""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(30, read=120),
+            limits=httpx.Limits(max_connections=16, max_keepalive_connections=8),
+        )
+    return _client
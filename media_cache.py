@@ -0,0 +1,169 @@
+import asyncio
+import os
+import threading
+from collections import OrderedDict
+
+from flask import Response, send_file
+
+import config
+import media
+
+# Media the dashboard has opened is kept on disk under MEDIA_PATH, named by
+# file_unique_id (Telegram's stable id for the file content), so repeat
+# views are served locally without any Telegram API call.
+MEDIA_PATH = getattr(config, 'MEDIA_PATH', './media')
+MAX_BYTES = getattr(config, 'MEDIA_CACHE_MAX_BYTES', 2 * 1024 ** 3)
+# Behind the bundled nginx, set to the internal location that aliases
+# MEDIA_PATH (see nginx.conf) so nginx streams the file with Range/ETag
+ACCEL_REDIRECT = os.environ.get('MEDIA_ACCEL_REDIRECT')
+DOWNLOAD_TIMEOUT = 120
+CHUNK_SIZE = 64 * 1024
+
+class MediaCache:
+    """Size-bounded LRU of downloaded media files on disk.
+
+    Files live at <root>/<uid[:2]>/<uid><ext>. The index (relative path and
+    size per file_unique_id, least recently used first) is rebuilt from the
+    directory on startup using mtimes, which hits refresh. Several API
+    workers can share one root: a miss first looks for a file another
+    process downloaded, and downloads go through per-process temp files.
+    Each process only evicts files it has indexed.
+    """
+
+    def __init__(self, root=MEDIA_PATH, max_bytes=MAX_BYTES):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._downloads = {}
+        self._scan()
+
+    def _scan(self):
+        found = []
+        if os.path.isdir(self.root):
+            for shard in os.listdir(self.root):
+                shard_dir = os.path.join(self.root, shard)
+                if len(shard) != 2 or not os.path.isdir(shard_dir):
+                    continue
+                for name in os.listdir(shard_dir):
+                    if name.startswith('.'):
+                        continue
+                    st = os.stat(os.path.join(shard_dir, name))
+                    found.append((st.st_mtime, os.path.splitext(name)[0], f'{shard}/{name}', st.st_size))
+        found.sort()
+        for _, uid, relpath, size in found:
+            self._entries[uid] = (relpath, size)
+            self.total_bytes += size
+
+    def lookup(self, file_unique_id):
+        """Relative path of a cached file, marking it recently used; None on a miss"""
+        with self._lock:
+            entry = self._entries.get(file_unique_id)
+            if entry is not None:
+                self._entries.move_to_end(file_unique_id)
+        if entry is None:
+            entry = self._adopt(file_unique_id)
+            if entry is None:
+                return None
+        try:
+            os.utime(self.path(entry[0]))
+        except FileNotFoundError:
+            with self._lock:
+                if self._entries.pop(file_unique_id, None) is not None:
+                    self.total_bytes -= entry[1]
+            return None
+        return entry[0]
+
+    def _adopt(self, file_unique_id):
+        """Index a file some other process put in the cache; None if there is none"""
+        shard = file_unique_id[:2]
+        try:
+            names = os.listdir(os.path.join(self.root, shard))
+        except FileNotFoundError:
+            return None
+        for name in names:
+            if os.path.splitext(name)[0] == file_unique_id:
+                relpath = f'{shard}/{name}'
+                try:
+                    size = os.path.getsize(self.path(relpath))
+                except FileNotFoundError:
+                    return None
+                self._add(file_unique_id, relpath, size)
+                return relpath, size
+        return None
+
+    def path(self, relpath):
+        return os.path.join(self.root, relpath)
+
+    async def fetch(self, bot, file_unique_id):
+        """Download a media item into the cache; returns its relative path or None if unknown.
+
+        Concurrent requests for the same item share one download.
+        """
+        relpath = self.lookup(file_unique_id)
+        if relpath is not None:
+            return relpath
+        task = self._downloads.get(file_unique_id)
+        if task is None:
+            task = asyncio.ensure_future(self._download(bot, file_unique_id))
+            self._downloads[file_unique_id] = task
+            task.add_done_callback(lambda _: self._downloads.pop(file_unique_id, None))
+        return await asyncio.shield(task)
+
+    async def _download(self, bot, file_unique_id):
+        file_path = await media.resolve_file_path(bot, file_unique_id)
+        if file_path is None:
+            return None
+        ext = os.path.splitext(file_path)[1][:10]
+        relpath = f'{file_unique_id[:2]}/{file_unique_id}{ext}'
+        target = self.path(relpath)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        partial = os.path.join(os.path.dirname(target), f'.{file_unique_id}.{os.getpid()}.part')
+        size = 0
+        try:
+            async with media.http_client().stream('GET', media.file_url(bot.token, file_path)) as response:
+                response.raise_for_status()
+                with open(partial, 'wb') as f:
+                    async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                        f.write(chunk)
+                        size += len(chunk)
+            os.replace(partial, target)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        self._add(file_unique_id, relpath, size)
+        return relpath
+
+    def _add(self, file_unique_id, relpath, size):
+        evicted = []
+        with self._lock:
+            previous = self._entries.pop(file_unique_id, None)
+            if previous is not None:
+                self.total_bytes -= previous[1]
+            self._entries[file_unique_id] = (relpath, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+                _, (old_relpath, old_size) = self._entries.popitem(last=False)
+                self.total_bytes -= old_size
+                evicted.append(old_relpath)
+        for old_relpath in evicted:
+            try:
+                os.remove(self.path(old_relpath))
+            except FileNotFoundError:
+                pass
+        if evicted:
+            print(f"Media cache evicted {len(evicted)} files ({self.total_bytes} bytes cached)")
+
+    def serve(self, relpath):
+        """Flask response for a cached file (X-Accel-Redirect when configured)"""
+        if ACCEL_REDIRECT:
+            response = Response()
+            response.headers['X-Accel-Redirect'] = ACCEL_REDIRECT.rstrip('/') + '/' + relpath
+            # Let nginx pick the Content-Type from the file extension
+            del response.headers['Content-Type']
+            return response
+        return send_file(self.path(relpath), conditional=True, etag=True, max_age=86400)
+
+cache = MediaCache()
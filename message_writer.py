@@ -0,0 +1,102 @@
+import atexit
+import datetime
+import threading
+
+import db
+
+FLUSH_ROWS = 100        # flush as soon as this many rows are queued
+FLUSH_INTERVAL = 0.05   # or after this many seconds, whichever comes first
+
+class MessageWriter:
+    """Write-behind queue for message rows.
+
+    Handlers call enqueue() and return immediately; a single writer thread
+    commits queued rows in one transaction per batch. Readers that must see
+    queued rows flush() first, and stop() (registered with atexit) flushes
+    whatever is left.
+    """
+
+    def __init__(self, flush_rows=FLUSH_ROWS, flush_interval=FLUSH_INTERVAL):
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self._rows = []
+        self._cond = threading.Condition()
+        # Held while a batch is committed and removed from _rows, so a
+        # caller's flush() and the writer thread never commit a row twice
+        self._commit_lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+            self._thread.start()
+
+    def enqueue(self, user_id, sender, message, timestamp=None):
+        if timestamp is None:
+            timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self._cond:
+            self._rows.append((user_id, sender, message, timestamp))
+            if len(self._rows) >= self.flush_rows:
+                self._cond.notify_all()
+        if self._thread is None:
+            self.start()
+
+    def flush(self):
+        """Commit everything queued so far (blocks the caller)"""
+        with self._commit_lock:
+            with self._cond:
+                batch = list(self._rows)
+            if batch:
+                db.save_messages_bulk(batch)
+                with self._cond:
+                    del self._rows[:len(batch)]
+                    self._cond.notify_all()
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout=10)
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._rows and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                # Give a burst a moment to accumulate into one transaction
+                if len(self._rows) < self.flush_rows:
+                    self._cond.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                # Rows stay queued and are retried on the next round
+                print(f"Message writer flush failed: {e}")
+                with self._cond:
+                    self._cond.wait(1)
+
+writer = MessageWriter()
+atexit.register(writer.stop)
+
+def save_message(user_id, sender, message, timestamp=None):
+    writer.enqueue(user_id, sender, message, timestamp)
+
+def save_media_messages(media_rows, message_rows):
+    """db.save_media_messages, committed after everything already queued so chat order holds"""
+    writer.flush()
+    db.save_media_messages(media_rows, message_rows)
+
+def get_messages_page(user_id, limit=100, before_id=None, after_id=None):
+    """db.get_messages_page, after committing queued rows so the newest page includes them"""
+    if before_id is None:
+        writer.flush()
+    return db.get_messages_page(user_id, limit, before_id, after_id)
@@ -0,0 +1,118 @@
+import datetime
+import threading
+import time
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+ONLINE_SECONDS = 5 * 60   # a user is online this long after their last message
+RESOLUTION = 5            # seconds per timing-wheel slot
+
+class PresenceTracker:
+    """Who is online, from the incoming-message path instead of timestamp scans.
+
+    The bot handlers call seen() for every user message. last_seen maps
+    user_id -> epoch seconds, so is_online()/online_ids() are dict lookups.
+    Expiry uses a timing wheel: each online user sits in the slot of the
+    moment they go offline, and a ticker thread empties one slot every
+    RESOLUTION seconds, calling on_change(user_id, False) for users that
+    were not seen again meanwhile. on_change(user_id, True) fires when an
+    offline user is seen.
+    """
+
+    def __init__(self, online_seconds=ONLINE_SECONDS, resolution=RESOLUTION, on_change=None):
+        self.online_seconds = online_seconds
+        self.resolution = resolution
+        self.on_change = on_change
+        self._lock = threading.Lock()
+        self._last_seen = {}
+        self._online = set()
+        self._slots = [set() for _ in range(int(online_seconds // resolution) + 2)]
+        self._tick = int(time.time() // resolution)
+        self._thread = None
+
+    def warm_up(self, conn):
+        """Mark users with a message inside the online window (called once at startup)"""
+        since = (datetime.datetime.now() - datetime.timedelta(seconds=self.online_seconds)).strftime(TIME_FORMAT)
+        rows = conn.execute("SELECT user_id, MAX(timestamp) FROM messages WHERE timestamp >= ? AND sender = 'user' "
+                            'GROUP BY user_id', (since,)).fetchall()
+        for user_id, timestamp in rows:
+            seen_at = datetime.datetime.strptime(timestamp, TIME_FORMAT).timestamp()
+            self.seen(user_id, seen_at, notify=False)
+
+    def _slot(self, seen_at):
+        return self._slots[int((seen_at + self.online_seconds) // self.resolution) % len(self._slots)]
+
+    def seen(self, user_id, seen_at=None, notify=True):
+        now = time.time()
+        seen_at = now if seen_at is None else seen_at
+        with self._lock:
+            previous = self._last_seen.get(user_id)
+            if previous is not None and previous >= seen_at:
+                return
+            if user_id in self._online:
+                self._slot(previous).discard(user_id)
+            self._last_seen[user_id] = seen_at
+            came_online = user_id not in self._online and seen_at + self.online_seconds > now
+            if seen_at + self.online_seconds > now:
+                self._online.add(user_id)
+                self._slot(seen_at).add(user_id)
+        if came_online and notify and self.on_change:
+            self.on_change(user_id, True)
+        if self._thread is None:
+            self.start()
+
+    def is_online(self, user_id):
+        with self._lock:
+            return user_id in self._online
+
+    def online_ids(self, user_ids):
+        with self._lock:
+            return {user_id for user_id in user_ids if user_id in self._online}
+
+    def last_seen(self, user_id):
+        """Last message time as a TIME_FORMAT string, or None if not seen since startup"""
+        with self._lock:
+            seen_at = self._last_seen.get(user_id)
+        return None if seen_at is None else datetime.datetime.fromtimestamp(seen_at).strftime(TIME_FORMAT)
+
+    def online_count(self):
+        with self._lock:
+            return len(self._online)
+
+    # --- Expiry ---
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='presence', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.resolution)
+            try:
+                self.expire()
+            except Exception as e:
+                print(f"Presence expiry failed: {e}")
+
+    def expire(self, now=None):
+        """Take offline everyone whose window ended before now"""
+        now = time.time() if now is None else now
+        went_offline = []
+        with self._lock:
+            current = int(now // self.resolution)
+            # Never walk more than one lap; older slots have wrapped around
+            start = max(self._tick, current - len(self._slots) + 1)
+            for tick in range(start, current + 1):
+                slot = self._slots[tick % len(self._slots)]
+                for user_id in list(slot):
+                    if self._last_seen[user_id] + self.online_seconds <= now:
+                        slot.discard(user_id)
+                        self._online.discard(user_id)
+                        went_offline.append(user_id)
+            self._tick = current
+        if self.on_change:
+            for user_id in went_offline:
+                self.on_change(user_id, False)
+        return went_offline
+
+tracker = PresenceTracker()
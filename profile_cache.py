@@ -0,0 +1,60 @@
+import threading
+import time
+from collections import OrderedDict
+
+CAPACITY = 20000
+PHOTO_REFRESH_INTERVAL = 30 * 60  # seconds between profile photo lookups per user
+
+class Profile:
+    __slots__ = ('full_name', 'username', 'photo_url', 'photo_checked_at')
+
+    def __init__(self, full_name, username, photo_url, photo_checked_at=0.0):
+        self.full_name = full_name
+        self.username = username
+        self.photo_url = photo_url
+        self.photo_checked_at = photo_checked_at
+
+class ProfileCache:
+    """LRU cache of what the users table holds for each user.
+
+    The message handler compares the incoming name/username against it and
+    only writes when something changed; claim_photo_refresh() hands out at
+    most one profile-photo lookup per user per PHOTO_REFRESH_INTERVAL.
+    """
+
+    def __init__(self, capacity=CAPACITY, photo_refresh_interval=PHOTO_REFRESH_INTERVAL):
+        self.capacity = capacity
+        self.photo_refresh_interval = photo_refresh_interval
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            profile = self._entries.get(user_id)
+            if profile is not None:
+                self._entries.move_to_end(user_id)
+            return profile
+
+    def put(self, user_id, full_name, username, photo_url, photo_checked_at=None):
+        with self._lock:
+            previous = self._entries.get(user_id)
+            if photo_checked_at is None:
+                photo_checked_at = previous.photo_checked_at if previous else 0.0
+            self._entries[user_id] = Profile(full_name, username, photo_url, photo_checked_at)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def claim_photo_refresh(self, user_id):
+        """True if the caller should look the photo up now; marks it as checked"""
+        now = time.monotonic()
+        with self._lock:
+            profile = self._entries.get(user_id)
+            if profile is None:
+                return False
+            if profile.photo_checked_at and now - profile.photo_checked_at < self.photo_refresh_interval:
+                return False
+            profile.photo_checked_at = now
+            return True
+
+profiles = ProfileCache()
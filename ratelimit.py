@@ -0,0 +1,44 @@
+import asyncio
+import time
+
+class TokenBucket:
+    """Async token bucket; pause() stops all takers, e.g. after a RetryAfter"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+def flood_wait_seconds(error):
+    """Seconds to back off for a flood-control error from either client, else None.
+
+    Covers python-telegram-bot's RetryAfter (retry_after) and Pyrogram's
+    FloodWait (value) without importing either library here.
+    """
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after is not None:
+        return getattr(retry_after, 'total_seconds', lambda: retry_after)()
+    if type(error).__name__ in ('FloodWait', 'SlowmodeWait'):
+        return getattr(error, 'value', None) or 1
+    return None
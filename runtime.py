@@ -0,0 +1,55 @@
+import asyncio
+
+class BotRuntime:
+    """Runs the PTB application and the Pyrogram client on the OutboundTelegram loop.
+
+    Both bot clients, the Flask-to-Telegram sends and background jobs share
+    one event loop and one Bot HTTP pool. Startup is ordered outbound loop ->
+    PTB (initialize, start, polling) -> Pyrogram -> background tasks;
+    stop() runs it in reverse. background is a list of coroutine functions
+    started as tasks once both clients are up.
+    """
+
+    def __init__(self, outbound, application, pyro_client=None, background=()):
+        self.outbound = outbound
+        self.application = application
+        self.pyro_client = pyro_client
+        self.background = list(background)
+        self._tasks = []
+        self.running = False
+
+    def start(self, timeout=120):
+        self.outbound.start()
+        self.outbound.run(self._start(), timeout=timeout)
+        self.running = True
+
+    def stop(self, timeout=30):
+        if not self.running:
+            return
+        self.running = False
+        try:
+            self.outbound.run(self._stop(), timeout=timeout)
+        except Exception as e:
+            print(f"Error stopping bot runtime: {e}")
+        self.outbound.stop()
+
+    async def _start(self):
+        await self.application.initialize()
+        await self.application.start()
+        await self.application.updater.start_polling()
+        print("Telegram bot running and waiting for user messages...")
+        if self.pyro_client is not None:
+            await self.pyro_client.start()
+            print("Pyrogram bot running and waiting for join requests...")
+        self._tasks = [asyncio.ensure_future(fn()) for fn in self.background]
+
+    async def _stop(self):
+        for task in self._tasks:
+            task.cancel()
+        if self.pyro_client is not None and self.pyro_client.is_connected:
+            await self.pyro_client.stop()
+        if self.application.updater.running:
+            await self.application.updater.stop()
+        if self.application.running:
+            await self.application.stop()
+        await self.application.shutdown()
@@ -0,0 +1,122 @@
+import datetime
+import threading
+from collections import deque
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+class DashboardStats:
+    """In-memory dashboard counters kept in step with the users/messages tables.
+
+    db.py calls record_user()/record_message() as rows are written and
+    warm_up() once at startup, so /dashboard-stats never has to COUNT.
+    When other processes write the tables too (the bots in bot_runner.py),
+    follower.DatabaseFollower sets followed and feeds add_messages() and
+    resync_users() instead, and the record_*() calls are ignored.
+    """
+
+    def __init__(self, active_minutes=60):
+        self.active_minutes = active_minutes
+        self._lock = threading.Lock()
+        self._total_users = 0
+        self._total_messages = 0
+        self._joins_by_day = {}
+        # Sliding window of (timestamp, user_id) plus the newest timestamp
+        # per user; a user stays active until their newest event expires.
+        self._events = deque()
+        self._last_seen = {}
+        self.followed = False
+
+    def _since(self):
+        return (datetime.datetime.now() - datetime.timedelta(minutes=self.active_minutes)).strftime(TIME_FORMAT)
+
+    def warm_up(self, conn):
+        """Load counters from the database (called from init_db)"""
+        since = self._since()
+        today = datetime.date.today()
+        total_users, joins_today = self._count_users(conn, today)
+        total_messages = conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+        recent = conn.execute('SELECT timestamp, user_id FROM messages WHERE timestamp >= ? ORDER BY timestamp',
+                              (since,)).fetchall()
+        with self._lock:
+            self._total_users = total_users
+            self._total_messages = total_messages
+            self._joins_by_day = {today.isoformat(): joins_today}
+            self._events = deque()
+            self._last_seen = {}
+            for timestamp, user_id in recent:
+                self._add_event(timestamp, user_id)
+
+    def _count_users(self, conn, today):
+        tomorrow = today + datetime.timedelta(days=1)
+        total_users = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+        joins_today = conn.execute('SELECT COUNT(*) FROM users WHERE join_date >= ? AND join_date < ?',
+                                   (today.isoformat(), tomorrow.isoformat())).fetchone()[0]
+        return total_users, joins_today
+
+    def resync_users(self, conn):
+        """Reload the user counters from the database"""
+        today = datetime.date.today()
+        total_users, joins_today = self._count_users(conn, today)
+        with self._lock:
+            self._total_users = total_users
+            self._joins_by_day[today.isoformat()] = joins_today
+
+    def _add_event(self, timestamp, user_id):
+        self._events.append((timestamp, user_id))
+        if timestamp >= self._last_seen.get(user_id, ''):
+            self._last_seen[user_id] = timestamp
+
+    def _expire(self, since):
+        events = self._events
+        while events and events[0][0] < since:
+            timestamp, user_id = events.popleft()
+            if self._last_seen.get(user_id) == timestamp:
+                del self._last_seen[user_id]
+
+    def record_user(self, join_date):
+        """A new row was inserted into users"""
+        self.record_users([join_date])
+
+    def record_users(self, join_dates):
+        """New rows were inserted into users, one join_date per row"""
+        if self.followed:
+            return
+        with self._lock:
+            for join_date in join_dates:
+                day = (join_date or '')[:10]
+                self._total_users += 1
+                self._joins_by_day[day] = self._joins_by_day.get(day, 0) + 1
+
+    def record_message(self, user_id, timestamp):
+        self.record_messages([(user_id, timestamp)])
+
+    def record_messages(self, rows):
+        """New rows were inserted into messages; rows are (user_id, timestamp)"""
+        if not self.followed:
+            self.add_messages(rows)
+
+    def add_messages(self, rows):
+        since = self._since()
+        with self._lock:
+            for user_id, timestamp in rows:
+                self._total_messages += 1
+                # Backdated rows that already fell out of the window never count
+                if timestamp >= since:
+                    self._add_event(timestamp, user_id)
+
+    def snapshot(self):
+        today = datetime.date.today().isoformat()
+        since = self._since()
+        with self._lock:
+            self._expire(since)
+            # Roll the daily join counters over at midnight
+            for day in [d for d in self._joins_by_day if d < today]:
+                del self._joins_by_day[day]
+            return {
+                'total_users': self._total_users,
+                'active_users': len(self._last_seen),
+                'total_messages': self._total_messages,
+                'new_joins_today': self._joins_by_day.get(today, 0),
+            }
+
+engine = DashboardStats()
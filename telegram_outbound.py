@@ -0,0 +1,81 @@
+import asyncio
+import threading
+
+from telegram import Bot
+from telegram.request import HTTPXRequest
+
+CONNECTION_POOL_SIZE = 32
+DEFAULT_TIMEOUT = 60
+
+class OutboundTelegram:
+    """Owns the event loop and Bot client used for sends from Flask and background jobs.
+
+    The loop runs forever on its own thread, so coroutines handed to submit()
+    actually execute. submit() returns a concurrent.futures.Future that can
+    be waited on with .result(timeout) from sync code; run() does that in one
+    step. Inside the loop, await the coroutines directly.
+    """
+
+    def __init__(self, token, pool_size=CONNECTION_POOL_SIZE):
+        self.bot = Bot(token, request=HTTPXRequest(
+            connection_pool_size=pool_size,
+            connect_timeout=30,
+            read_timeout=30,
+            write_timeout=60,
+            pool_timeout=30,
+        ), get_updates_request=HTTPXRequest(connect_timeout=30, read_timeout=30))
+        self.loop = None
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop, name='telegram-outbound', daemon=True)
+        self._thread.start()
+        # Initialize the Bot (HTTP client, get_me) on its own loop before first use.
+        # A failure here is not fatal: calls made later retry the connection.
+        try:
+            self.run(self.bot.initialize(), timeout=DEFAULT_TIMEOUT)
+        except Exception as e:
+            print(f"Could not initialize outbound Telegram bot: {e}")
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        """Schedule a coroutine on the outbound loop; returns a concurrent Future"""
+        if self._thread is None:
+            coro.close()
+            raise RuntimeError('OutboundTelegram is not started')
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(_log_failure)
+        return future
+
+    def run(self, coro, timeout=DEFAULT_TIMEOUT):
+        """Run a coroutine on the outbound loop and wait for its result"""
+        future = self.submit(coro)
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+    def stop(self, timeout=10):
+        if self._thread is None:
+            return
+        try:
+            self.run(self.bot.shutdown(), timeout=timeout)
+        except Exception as e:
+            print(f"Error shutting down outbound Telegram bot: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=timeout)
+        self._thread = None
+
+def _log_failure(future):
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is not None:
+        print(f"Outbound Telegram call failed: {error}")
@@ -1,6 +1,7 @@
-from pyrogram import Client, filters
-from pyrogram.types import ChatJoinRequest
+from pyrogram import Client, idle
 import config  # <-- config.py import করুন
+from db import init_db
+from join_requests import JoinRequestPipeline, BACKEND_MTPROTO, catch_up_client
 
 app = Client(
     "AutoApproveBot",
@@ -12,23 +13,22 @@ app = Client(
 CHAT_ID = config.CHAT_ID
 WELCOME_TEXT = getattr(config, "WELCOME_TEXT", "🎉 Hi {mention}, you are now a member of {title}!")
 
-print("Bot is running and waiting for join requests...")
+init_db()
 
-@app.on_chat_join_request(filters.chat(CHAT_ID))
-async def approve_and_dm(client: Client, join_request: ChatJoinRequest):
-    user = join_request.from_user
-    chat = join_request.chat
+# Requests are queued and approved under a flood-aware rate limit;
+# welcome DMs go out on a lower-priority lane
+join_pipeline = JoinRequestPipeline(BACKEND_MTPROTO, chat_id=CHAT_ID, welcome_text=WELCOME_TEXT)
+join_pipeline.register(None, app)
 
-    await client.approve_chat_join_request(chat.id, user.id)
-    print(f"Approved: {user.first_name} ({user.id}) in {chat.title}")
+async def main():
+    async with app:
+        print("Bot is running and waiting for join requests...")
+        # Approve whatever piled up while the bot was offline, then keep listening.
+        # Listing pending requests needs a chat admin's user session.
+        lister = catch_up_client(config.API_ID, config.API_HASH, getattr(config, 'CATCH_UP_SESSION_STRING', None))
+        if lister is not None:
+            async with lister:
+                await join_pipeline.catch_up(app, lister)
+        await idle()
 
-    try:
-        await client.send_message(
-            user.id,
-            WELCOME_TEXT.format(mention=user.mention, title=chat.title)
-        )
-        print(f"DM sent to {user.first_name} ({user.id})")
-    except Exception as e:
-        print(f"Failed to send DM to {user.first_name} ({user.id}): {e}")
-
-app.run()
\ No newline at end of file
+app.run(main())